@@ -0,0 +1,299 @@
+#!/usr/bin/env python2.6
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+r"""Offline throughput benchmarks for migration.py.
+
+Generates synthetic mbox corpora and uploads them to the local mock
+server (mockserver.py), reporting messages/sec, MB/sec, p50/p99 request
+latency and peak RSS for each corpus and concurrency level, for the
+blocking client and optionally the asynchronous one. Request
+encoding (schema and multipart body) is also measured on its own, without
+the network.
+
+Each measurement runs in a fresh process so that peak RSS is its own, and
+the mock server runs in another process so that it does not compete with
+the client for the interpreter lock.
+
+Example Usage:
+
+    > python benchmark.py --corpus 2000x4k,200x256k,10x8M --concurrency 1,8 --latency 0.02
+
+"""
+
+##############################################################################
+##############################################################################
+
+import os, os.path, sys, time, random, optparse, tempfile, resource
+import multiprocessing
+
+import migration, mbox2gdata, mockserver
+
+##############################################################################
+##############################################################################
+
+SIZE_SUFFIXES = { 'k' : 2**10, 'M' : 2**20, 'G' : 2**30 }
+
+MESSAGE_HEADER = '\n'.join(['From: Benchmark <bench@example.com>',
+                            'To: User <user@example.com>',
+                            'Date: Sat, 01 Jan 2000 00:00:00 +0000',
+                            'Message-ID: <%d.%d@bench.example.com>',
+                            'Subject: Benchmark message %d',
+                            'MIME-Version: 1.0',
+                            'Content-Type: text/plain; charset=us-ascii',
+                            '', ''])
+
+def parse_size(text):
+    if text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+def parse_corpus(text):
+    r"""Parses 'COUNTxSIZE', e.g. '1000x4k', into a 2-tuple of integers."""
+    count, size = text.split('x', 1)
+    return int(count), parse_size(size)
+
+def corpus_path(directory, count, size):
+    return os.path.join(directory, 'bench-%dx%d.mbox' % (count, size))
+
+def make_corpus(path, count, size, seed=0):
+    r"""Writes an mbox of `count` messages of about `size` bytes each,
+    unless it already exists."""
+    if os.path.exists(path):
+        return path
+    rand = random.Random(seed)
+    line = ''.join([chr(rand.randint(ord('a'), ord('z'))) for i in xrange(76)]) + '\n'
+    f = open(path + '.tmp', 'wb')
+    try:
+        for i in xrange(count):
+            header = MESSAGE_HEADER % (seed, i, i)
+            lines = max(1, (size - len(header)) / len(line))
+            f.write('From bench@example.com Sat Jan  1 00:00:00 2000\n')
+            f.write(header)
+            f.write(line * lines)
+            f.write('\n')
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+    return path
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def peak_rss():
+    r"""Peak resident set size of this process in MB (ru_maxrss is kB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+##############################################################################
+##############################################################################
+
+def serve(behavior, connection):
+    server = mockserver.MigrationServer(behavior=behavior)
+    connection.send(server.url)
+    server.serve_forever()
+
+def run_upload(url, path, concurrency, connection):
+    latencies = []
+    post_request = migration.post_request
+
+    def timed(*args):
+        start = time.time()
+        try:
+            return post_request(*args)
+        finally:
+            latencies.append(time.time() - start)
+
+    migration.post_request = timed
+    service = migration.EmailMigrationService('bench@example.com', 'secret',
+                                              concurrency,
+                                              pool=migration.ConnectionPool(),
+                                              server=url,
+                                              auth_server=url)
+    service.authenticate()
+    mbox = mbox2gdata.MboxMap(path)
+    sizes = [0, 0]
+
+    def messages():
+        for offset, message in mbox:
+            sizes[0] += 1
+            sizes[1] += len(message)
+            yield message
+
+    start = time.time()
+    failed = service.upload_messages(messages(), migration.MAIL_INBOX, ['benchmark'])
+    elapsed = time.time() - start
+    mbox.close()
+    connection.send({ 'messages' : sizes[0],
+                      'bytes' : sizes[1],
+                      'elapsed' : elapsed,
+                      'failed' : len(failed),
+                      'p50' : percentile(latencies, 0.5),
+                      'p99' : percentile(latencies, 0.99),
+                      'rss' : peak_rss() })
+
+def run_async_upload(url, path, concurrency, connection):
+    latencies = []
+    loop = migration.EventLoop()
+    pool = migration.AsyncConnectionPool(loop, maxsize=concurrency)
+    urlopen = pool.urlopen
+
+    def timed(url, body, headers, callback, method=None):
+        start = time.time()
+
+        def finished(response, error):
+            latencies.append(time.time() - start)
+            callback(response, error)
+
+        urlopen(url, body, headers, finished, method)
+
+    pool.urlopen = timed
+    service = migration.AsyncEmailMigrationService('bench@example.com', 'secret',
+                                                   concurrency,
+                                                   pool=pool,
+                                                   server=url,
+                                                   auth_server=url)
+    mbox = mbox2gdata.MboxMap(path)
+    sizes = [0, 0]
+    failed = []
+
+    def messages():
+        for offset, message in mbox:
+            sizes[0] += 1
+            sizes[1] += len(message)
+            yield message
+
+    service.authenticate()
+    loop.run()
+    del latencies[:]
+    start = time.time()
+    service.upload_messages(messages(), failed.extend, migration.MAIL_INBOX, ['benchmark'])
+    loop.run()
+    elapsed = time.time() - start
+    mbox.close()
+    connection.send({ 'messages' : sizes[0],
+                      'bytes' : sizes[1],
+                      'elapsed' : elapsed,
+                      'failed' : len(failed),
+                      'p50' : percentile(latencies, 0.5),
+                      'p99' : percentile(latencies, 0.99),
+                      'rss' : peak_rss() })
+
+def run_encode(path, connection):
+    mbox = mbox2gdata.MboxMap(path)
+    sizes = [0, 0]
+    start = time.time()
+    for offset, message in mbox:
+        schema = migration.build_mail_schema(migration.MAIL_INBOX, ['benchmark'])
+        request = migration.MailRequest(schema)
+        body = request.body(message)
+        request.headers('token', body)
+        for chunk in body:
+            pass
+        sizes[0] += 1
+        sizes[1] += len(message)
+    elapsed = time.time() - start
+    mbox.close()
+    connection.send({ 'messages' : sizes[0],
+                      'bytes' : sizes[1],
+                      'elapsed' : elapsed,
+                      'failed' : 0,
+                      'p50' : 0.0,
+                      'p99' : 0.0,
+                      'rss' : peak_rss() })
+
+def measure(target, *args):
+    r"""Runs target(*args, connection) in a child process and returns what it sends."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=args + (child,))
+    process.start()
+    try:
+        return parent.recv()
+    finally:
+        process.join()
+
+##############################################################################
+##############################################################################
+
+REPORT_FORMAT = '%-14s %-8s %8s %10s %8s %8s %8s %7s %8s'
+
+def report(corpus, mode, result):
+    elapsed = result['elapsed'] or 1e-9
+    print REPORT_FORMAT % (corpus,
+                           mode,
+                           result['messages'],
+                           '%.1f' % (result['messages'] / elapsed),
+                           '%.2f' % (result['bytes'] / elapsed / 2**20),
+                           '%.1f' % (result['p50'] * 1000),
+                           '%.1f' % (result['p99'] * 1000),
+                           result['failed'],
+                           '%.1f' % result['rss'])
+
+def main(argv):
+    optparser = optparse.OptionParser(description='Benchmarks uploads against a local mock server.')
+    optparser.add_option('--corpus', dest='corpus', default='2000x4k,200x256k,10x8M',
+                         help='comma separated COUNTxSIZE corpora, e.g. 1000x4k')
+    optparser.add_option('--concurrency', dest='concurrency', default='1,8',
+                         help='comma separated concurrency levels')
+    optparser.add_option('--corpus-dir', dest='directory', default=tempfile.gettempdir(),
+                         help='where generated corpora are kept between runs')
+    optparser.add_option('--latency', dest='latency', type='float', default=0.0,
+                         help='mean seconds of server latency per request')
+    optparser.add_option('--jitter', dest='jitter', type='float', default=0.0,
+                         help='maximum seconds of random variation in latency')
+    optparser.add_option('--error-rate', dest='error_rate', type='float', default=0.0,
+                         help='fraction of uploads that fail with 500')
+    optparser.add_option('--throttle', dest='throttle', type='int', default=None,
+                         help='uploads per second beyond which the server returns 503')
+    optparser.add_option('--async', dest='async', default=False, action='store_true',
+                         help='also measure AsyncEmailMigrationService at each concurrency level')
+    optparser.add_option('--no-encode', dest='encode', default=True, action='store_false',
+                         help='skip the encoding-only measurement')
+    options, args = optparser.parse_args(argv[1:])
+
+    corpora = [parse_corpus(text) for text in options.corpus.split(',')]
+    levels = [int(text) for text in options.concurrency.split(',')]
+
+    behavior = mockserver.Behavior(options.latency, options.jitter,
+                                   options.error_rate, options.throttle)
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(behavior, child))
+    server.daemon = True
+    server.start()
+    url = parent.recv()
+
+    print REPORT_FORMAT % ('corpus', 'mode', 'msgs', 'msgs/s', 'MB/s', 'p50 ms', 'p99 ms', 'failed', 'RSS MB')
+    try:
+        for count, size in corpora:
+            name = '%dx%d' % (count, size)
+            path = make_corpus(corpus_path(options.directory, count, size), count, size)
+            if options.encode:
+                report(name, 'encode', measure(run_encode, path))
+            for concurrency in levels:
+                report(name, 'c=%d' % concurrency, measure(run_upload, url, path, concurrency))
+                if options.async:
+                    report(name, 'a=%d' % concurrency, measure(run_async_upload, url, path, concurrency))
+    finally:
+        server.terminate()
+
+##############################################################################
+##############################################################################
+
+if __name__ == '__main__':
+    main(sys.argv)
+
+##############################################################################
+##############################################################################
@@ -31,7 +31,24 @@ History:
 ##############################################################################
 ##############################################################################
 
-import os, os.path, sys, socket, time, optparse, email, mailbox
+import os, os.path, sys, socket, time, optparse, mmap, threading, Queue
+import re, math, struct, hashlib, sqlite3, zlib, bz2, bisect, array, calendar
+import shutil, tempfile
+import email.utils
+import multiprocessing
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import migration
 
@@ -42,6 +59,7 @@ OUTPUT_TAG = "mbox2gdata"
 FOLDER_DELIM = '-'
 FAILED_PREFIX = "%s%sfailed" % (OUTPUT_TAG,FOLDER_DELIM)
 FAILURE_HEADER = 'X-%s-Failure' % OUTPUT_TAG
+RETRY_SUFFIX = '.retry'
 UNLABELED_FOLDER = 'all'
 FLAGS = { 'INBOX' : migration.MAIL_INBOX,
           'UNREAD' : migration.MAIL_UNREAD,
@@ -53,6 +71,1033 @@ FLAGS = { 'INBOX' : migration.MAIL_INBOX,
 ##############################################################################
 ##############################################################################
 
+class MboxReader(object):
+    r"""Single pass, streaming reader for mbox files.
+    
+    Unlike mailbox.mbox, no table of contents is built up front: messages
+    are yielded as each 'From ' separator line is found, so the first 
+    message is available immediately and memory use does not grow with the
+    size of the file. Messages are yielded without the separator line, 
+    as with mailbox.mbox.get_string.
+    
+    `position` is the offset just past the last message read and `size` 
+    is the size of the file, for reporting progress. Reading starts from 
+    `offset`, which must be the offset of a separator line.
+    
+    """
+    
+    SEPARATOR = 'From '
+    BLOCK_SIZE = 2**20
+    HEADER_LIMIT = 2**16
+    
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.offset = offset
+        self.position = 0
+        self.cursor = None
+    
+    progress = property(lambda self: self.size and (100 * self.position / self.size) or 100)
+    
+    def open(self):
+        return open(self.path, 'rb')
+    
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+    
+    def __iter__(self):
+        r"""Yields 2-tuples of (offset, message string).
+        
+        The offset is the byte offset of the message's separator line.
+        """
+        for start, message, next in self.scan(self.offset):
+            yield start, message
+    
+    def scan(self, offset):
+        r"""Yields 3-tuples of (offset, message, offset of the next separator or -1)."""
+        f = self.open()
+        try:
+            start = None
+            lines = []
+            position = offset
+            f.seek(position)
+            for line in f:
+                if line.startswith(self.SEPARATOR):
+                    if start is not None:
+                        self.position = position
+                        yield start, self.join(lines), position
+                    start = position
+                    lines = []
+                elif start is not None:
+                    lines.append(line)
+                position += len(line)
+            if start is not None:
+                self.position = position
+                yield start, self.join(lines), -1
+        finally:
+            f.close()
+    
+    def read(self, start):
+        r"""Returns the message whose separator line is at start.
+        
+        Reading continues from the previous read where possible, so reading
+        messages in the order of their offsets passes over the file once.
+        
+        Returns:
+            A 2-tuple of (message, offset of the next separator or -1).
+        """
+        if self.cursor is None or self.cursor.start > start:
+            self.close()
+            self.cursor = Cursor(self.scan(start))
+        for offset, message, next in self.cursor:
+            if offset == start:
+                return message, next
+            if offset > start:
+                break
+        raise KeyError('No message at offset %d of %s' % (start, self.path))
+    
+    def find(self, offset):
+        r"""Returns the offset of the next separator line, or -1."""
+        for start, message, next in self.scan(offset):
+            return start
+        return -1
+    
+    def sizes(self):
+        r"""Yields the size of each message, separator line included.
+        
+        Only the separator lines are looked for, in large blocks, so no 
+        message strings are built.
+        """
+        pattern = '\n' + self.SEPARATOR
+        f = self.open()
+        try:
+            start = None
+            position = 0
+            tail = '\n'
+            while True:
+                block = f.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                data = tail + block
+                base = position - len(tail)
+                found = data.find(pattern)
+                while found >= 0:
+                    if start is not None:
+                        yield base + found + 1 - start
+                    start = base + found + 1
+                    found = data.find(pattern, found + 1)
+                position += len(block)
+                tail = data[1 - len(pattern):]
+            if start is not None:
+                yield position - start
+        finally:
+            f.close()
+    
+    def headers(self):
+        r"""Yields 3-tuples of (offset, size, header block) of each message."""
+        for start, message, next in self.scan(0):
+            end = message.find('\n\n', 0, self.HEADER_LIMIT)
+            if end < 0:
+                end = self.HEADER_LIMIT
+            yield start, len(message), message[:end]
+    
+    def join(self, lines):
+        # the blank line preceding a separator belongs to the mbox format
+        if lines and lines[-1] == '\n':
+            del lines[-1]
+        return ''.join(lines)
+
+class Cursor(object):
+    r"""Iterator over MboxReader.scan that remembers the last offset reached."""
+    
+    def __init__(self, scan):
+        self.scan = scan
+        self.start = 0
+    
+    def __iter__(self):
+        for item in self.scan:
+            self.start = item[0]
+            yield item
+    
+    def close(self):
+        self.scan.close()
+
+class MboxMap(MboxReader):
+    r"""Memory-mapped reader for mbox files.
+    
+    Messages are yielded as read-only buffer slices of the mapped file 
+    instead of strings, so a message is never copied in memory before 
+    it is written to the network. The mapping is released by close(), 
+    after which the slices are no longer valid.
+    
+    """
+    
+    def __init__(self, path, offset=0):
+        MboxReader.__init__(self, path, offset)
+        self.map = None
+        if self.size:
+            f = open(path, 'rb')
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+    
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+    
+    def __iter__(self):
+        r"""Yields 2-tuples of (offset, message buffer)."""
+        if self.map is None:
+            return
+        start = self.find(self.offset)
+        while start >= 0:
+            message, next = self.read(start)
+            yield start, message
+            start = next
+    
+    def read(self, start):
+        r"""Returns the message whose separator line is at start.
+        
+        Returns:
+            A 2-tuple of (message buffer, offset of the next separator or -1).
+        """
+        body = self.map.find('\n', start) + 1 or self.size
+        next = self.find(body)
+        if next < 0:
+            end = self.size
+        else:
+            end = next
+        self.position = end
+        return buffer(self.map, body, self.trim(body, end) - body), next
+    
+    def find(self, offset):
+        r"""Returns the offset of the next separator line, or -1."""
+        if offset == 0:
+            if self.map[:len(self.SEPARATOR)] == self.SEPARATOR:
+                return 0
+            offset = 1
+        found = self.map.find('\n' + self.SEPARATOR, offset - 1)
+        if found < 0:
+            return found
+        return found + 1
+    
+    def sizes(self):
+        r"""Yields the size of each message, separator line included."""
+        if self.map is None:
+            return
+        start = self.find(0)
+        while start >= 0:
+            next = self.find(start + 1)
+            yield (next < 0 and self.size or next) - start
+            start = next
+    
+    def headers(self):
+        r"""Yields 3-tuples of (offset, size, header block) of each message.
+        
+        The header block starts with the separator line, and only it is 
+        copied out of the mapping.
+        """
+        if self.map is None:
+            return
+        start = self.find(0)
+        while start >= 0:
+            next = self.find(start + 1)
+            end = next < 0 and self.size or next
+            header = self.map.find('\n\n', start, min(end, start + self.HEADER_LIMIT))
+            if header < 0:
+                header = min(end, start + self.HEADER_LIMIT)
+            yield start, end - start, self.map[start:header]
+            start = next
+    
+    def trim(self, start, end):
+        # the blank line preceding a separator belongs to the mbox format
+        if end > start and self.map[end-2:end] == '\n\n':
+            return end - 1
+        return end
+
+class DecompressingFile(object):
+    r"""Read-only file of the decompressed contents of a compressed file.
+    
+    Iterating yields lines, as with a file; decompression happens chunk by
+    chunk as the lines are read, so the decompressed contents are never
+    held in memory or written to disk. Concatenated compressed streams, 
+    e.g. from pigz or pbzip2, are read one after another. 
+    
+    `consumed` is the number of compressed bytes read so far.
+    
+    """
+    
+    CHUNK_SIZE = 2**16
+    
+    def __init__(self, path, decompressor):
+        self.file = open(path, 'rb')
+        self.decompressor = decompressor
+        self.stream = decompressor()
+        self.head = ''
+        self.consumed = 0
+    
+    def close(self):
+        self.file.close()
+    
+    def decompress(self):
+        r"""Returns the next chunk of decompressed data, or '' at the end."""
+        while True:
+            data = self.file.read(self.CHUNK_SIZE)
+            if not data:
+                flush = getattr(self.stream, 'flush', None)
+                self.stream = self.decompressor()
+                return flush and flush() or ''
+            self.consumed += len(data)
+            chunks = [self.feed(data)]
+            unused = getattr(self.stream, 'unused_data', '')
+            while unused:
+                self.stream = self.decompressor()
+                chunks.append(self.stream.decompress(unused))
+                unused = getattr(self.stream, 'unused_data', '')
+            data = ''.join(chunks)
+            if data:
+                return data
+    
+    def feed(self, data):
+        r"""Decompresses data, starting a new stream if the current one ended
+        exactly at the end of the previous chunk, leaving no unused_data."""
+        if getattr(self.stream, 'eof', False):
+            self.stream = self.decompressor()
+        try:
+            return self.stream.decompress(data)
+        except EOFError:
+            # bz2 has no eof attribute, and refuses data after the end
+            self.stream = self.decompressor()
+            return self.stream.decompress(data)
+    
+    def read(self, size):
+        r"""Returns at most `size` bytes of decompressed data, or '' at the end."""
+        data = self.head or self.decompress()
+        self.head = data[size:]
+        return data[:size]
+    
+    def seek(self, offset):
+        r"""Skips to `offset` bytes into the decompressed data of a file 
+        that has not been read yet."""
+        while offset > 0:
+            data = self.decompress()
+            if not data:
+                break
+            if len(data) > offset:
+                self.head = data[offset:]
+                break
+            offset -= len(data)
+    
+    def __iter__(self):
+        partial = ''
+        data, self.head = self.head, ''
+        while True:
+            if not data:
+                data = self.decompress()
+                if not data:
+                    break
+            lines = data.split('\n')
+            lines[0] = partial + lines[0]
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+            data = ''
+        if partial:
+            yield partial
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+# decompressor factory for each file name suffix, or the module it needs
+COMPRESSORS = { '.gz' : gzip_decompressor,
+                '.bz2' : bz2.BZ2Decompressor,
+                '.xz' : lzma and lzma.LZMADecompressor or 'lzma',
+                '.zst' : zstandard and zstd_decompressor or 'zstandard' }
+
+class CompressedMboxReader(MboxReader):
+    r"""Streaming reader for gzip, bzip2, xz or zstd compressed mbox files.
+    
+    The mbox is decompressed on the fly, without an uncompressed copy on 
+    disk. Offsets are offsets into the decompressed mbox, so reading from 
+    an offset, e.g. to resume, decompresses everything before it again.
+    xz needs the lzma module (in backports.lzma for Python 2), and zstd 
+    needs the zstandard module.
+    
+    """
+    
+    def __init__(self, path, offset=0):
+        MboxReader.__init__(self, path, offset)
+        self.decompressor = COMPRESSORS[os.path.splitext(path)[1]]
+        if isinstance(self.decompressor, str):
+            raise RuntimeError('Reading %s requires the %s module' % (path, self.decompressor))
+        self.file = None
+    
+    progress = property(lambda self: self.size and self.file 
+                                     and (100 * self.file.consumed / self.size) or 100)
+    
+    def open(self):
+        self.file = DecompressingFile(self.path, self.decompressor)
+        return self.file
+
+class MaildirReader(object):
+    r"""Reader for Maildir directories, with the interface of MboxReader.
+    
+    The messages in the cur and new subdirectories are read in the order
+    of their unique names, which do not change when a mail client moves 
+    a message from new to cur or changes its flags. The offset of a 
+    message is its index in that order.
+    
+    """
+    
+    SUBDIRS = ('cur', 'new')
+    INFO_DELIM = ':'
+    HEADER_CHUNK_SIZE = 2**13
+    HEADER_LIMIT = MboxReader.HEADER_LIMIT
+    
+    def __init__(self, path, offset=0):
+        self.path = path
+        names = []
+        for subdir in self.SUBDIRS:
+            for name in os.listdir(os.path.join(path, subdir)):
+                if not name.startswith('.'):
+                    names.append((name.split(self.INFO_DELIM, 1)[0], os.path.join(subdir, name)))
+        names.sort()
+        self.files = [file for unique, file in names]
+        self.size = len(self.files)
+        self.offset = offset
+        self.position = 0
+    
+    progress = property(lambda self: self.size and (100 * self.position / self.size) or 100)
+    
+    @classmethod
+    def is_maildir(cls, path):
+        return os.path.isdir(path) and all([os.path.isdir(os.path.join(path, subdir)) 
+                                            for subdir in cls.SUBDIRS])
+    
+    def close(self):
+        pass
+    
+    def __iter__(self):
+        r"""Yields 2-tuples of (offset, message string)."""
+        start = self.find(self.offset)
+        while start >= 0:
+            message, next = self.read(start)
+            yield start, message
+            start = next
+    
+    def read(self, start):
+        r"""Returns a 2-tuple of (message string, offset of the next message or -1)."""
+        f = open(os.path.join(self.path, self.files[start]), 'rb')
+        try:
+            message = f.read()
+        finally:
+            f.close()
+        self.position = start + 1
+        return message, self.find(start + 1)
+    
+    def find(self, offset):
+        r"""Returns the offset of the first message at or after offset, or -1."""
+        if offset < len(self.files):
+            return offset
+        return -1
+    
+    def sizes(self):
+        r"""Yields the size of each message file."""
+        for file in self.files:
+            yield os.path.getsize(os.path.join(self.path, file))
+    
+    def headers(self):
+        r"""Yields 3-tuples of (offset, size, header block) of each message."""
+        for offset, file in enumerate(self.files):
+            f = open(os.path.join(self.path, file), 'rb')
+            try:
+                header = ''
+                while True:
+                    chunk = f.read(self.HEADER_CHUNK_SIZE)
+                    header += chunk
+                    end = header.find('\n\n')
+                    if end >= 0:
+                        header = header[:end]
+                        break
+                    if not chunk or len(header) >= self.HEADER_LIMIT:
+                        break
+                yield offset, os.fstat(f.fileno()).st_size, header
+            finally:
+                f.close()
+
+def folder_suffix(path):
+    r"""Returns the compression suffix of a folder's file name, or ''."""
+    suffix = os.path.splitext(path)[1]
+    if suffix in COMPRESSORS:
+        return suffix
+    return ''
+
+def open_folder(path, offset=0):
+    r"""Returns a reader for a Maildir directory or a plain or compressed mbox file."""
+    if os.path.isdir(path):
+        return MaildirReader(path, offset)
+    if folder_suffix(path):
+        return CompressedMboxReader(path, offset)
+    return MboxMap(path, offset)
+
+class Journal(object):
+    r"""Append-only checkpoint journal of the messages uploaded from an mbox.
+    
+    Each line records the byte range '<start> <stop>' of one uploaded 
+    message, where stop is the offset of the following message. Lines are 
+    written as messages are acknowledged and fsync'd every SYNC_INTERVAL 
+    records, so a crash re-uploads at most that many messages.
+    
+    When resuming, the longest run of acknowledged messages from the start
+    of the file is followed through the recorded ranges, so reading can 
+    begin at the first unacknowledged message without rescanning.
+    
+    """
+    
+    SUFFIX = '.journal'
+    SYNC_INTERVAL = 64
+    
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.acked = {}
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            self.load()
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+    
+    def __len__(self):
+        return len(self.acked)
+    
+    def __contains__(self, offset):
+        return offset in self.acked
+    
+    def load(self):
+        f = open(self.path, 'rb')
+        try:
+            torn = False
+            for line in f:
+                torn = not line.endswith('\n')
+                try:
+                    start, stop = [int(field) for field in line.split()]
+                except ValueError:
+                    continue
+                self.acked[start] = stop
+        finally:
+            f.close()
+        if torn:
+            # a partial record was being written when we stopped
+            f = open(self.path, 'ab')
+            try:
+                f.write('\n')
+            finally:
+                f.close()
+    
+    def resume(self, offset):
+        r"""Returns the offset of the first unacknowledged message at or after offset."""
+        while offset in self.acked:
+            offset = self.acked[offset]
+        return offset
+    
+    def record(self, start, stop):
+        self.lock.acquire()
+        try:
+            self.acked[start] = stop
+            self.file.write('%d %d\n' % (start, stop))
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.SYNC_INTERVAL:
+                self.sync()
+        finally:
+            self.lock.release()
+    
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            if not self.file.closed:
+                self.sync()
+                self.file.close()
+        finally:
+            self.lock.release()
+
+class FailureSink(object):
+    r"""Append-only mbox of the messages that failed to upload.
+    
+    Each message is written as it is, behind a new separator line and a 
+    FAILURE_HEADER line giving the reason, without parsing it. Writes are 
+    buffered and fsync'd every SYNC_INTERVAL messages and on close.
+    
+    Beside the mbox, a sidecar index has a line '<offset> <cause> <reason>'
+    for each failed message, where offset is the byte offset of its 
+    separator line, so failures can be summarized without reading the mbox.
+    The files are created on the first failure.
+    
+    """
+    
+    SUFFIX = '.reasons'
+    SYNC_INTERVAL = 64
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.index = None
+        self.offset = 0
+        self.count = 0
+        self.unsynced = 0
+    
+    def __len__(self):
+        return self.count
+    
+    def open(self):
+        self.file = open(self.path, 'a+b')
+        self.index = open(self.path + self.SUFFIX, 'ab')
+        self.file.seek(0, os.SEEK_END)
+        self.offset = self.file.tell()
+        if self.offset:
+            # a separator must follow a blank line
+            self.file.seek(-min(2, self.offset), os.SEEK_END)
+            ending = self.file.read(2)
+            self.file.seek(0, os.SEEK_END)
+            if ending != '\n\n':
+                self.file.write('\n')
+                self.offset += 1
+    
+    def add(self, message, reason):
+        r"""Appends a message (string or buffer) with the reason it failed."""
+        if self.file is None:
+            self.open()
+        cause = migration.error_cause(reason)
+        reason = ' '.join(str(reason).split())
+        text = str(message)
+        # quote separator lines in the message, as mailbox.mbox does
+        if text.startswith('From '):
+            text = '>' + text
+        text = text.replace('\nFrom ', '\n>From ')
+        if not text.endswith('\n'):
+            text += '\n'
+        chunks = ['From MAILER-DAEMON %s\n' % time.asctime(time.gmtime()),
+                  '%s: %s\n' % (FAILURE_HEADER, reason),
+                  text, 
+                  '\n']
+        for chunk in chunks:
+            self.file.write(chunk)
+        self.index.write('%d %s %s\n' % (self.offset, cause, reason))
+        self.offset += sum([len(chunk) for chunk in chunks])
+        self.count += 1
+        self.unsynced += 1
+        if self.unsynced >= self.SYNC_INTERVAL:
+            self.sync()
+    
+    def sync(self):
+        if self.file is None:
+            return
+        for f in self.file, self.index:
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+    
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+class BloomFilter(object):
+    r"""Fixed-size Bloom filter over strings.
+    
+    Sized for `capacity` entries at false positive rate `error`; memory 
+    use does not grow beyond that however many entries are added.
+    """
+    
+    def __init__(self, capacity, error=0.01):
+        self.bits = max(8, int(-capacity * math.log(error) / math.log(2)**2))
+        self.hashes = max(1, int(round(self.bits * math.log(2) / capacity)))
+        self.array = bytearray((self.bits + 7) / 8)
+        self.count = 0
+    
+    def positions(self, key):
+        digest = hashlib.md5(key).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.bits
+    
+    def add(self, key):
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+    
+    def save(self, path):
+        f = open(path, 'wb')
+        try:
+            f.write(struct.pack('<QQQ', self.bits, self.hashes, self.count))
+            f.write(self.array)
+        finally:
+            f.close()
+    
+    def load(self, path):
+        r"""Loads a saved filter; returns False if it does not match this one."""
+        f = open(path, 'rb')
+        try:
+            header = f.read(struct.calcsize('<QQQ'))
+            bits, hashes, count = struct.unpack('<QQQ', header)
+            if (bits, hashes) != (self.bits, self.hashes):
+                return False
+            self.array = bytearray(f.read())
+            self.count = count
+        finally:
+            f.close()
+        return len(self.array) == (self.bits + 7) / 8
+
+class DedupEntry(object):
+    r"""Where a message is uploaded from, and with which labels."""
+    
+    def __init__(self, path, offset, properties, labels, uploaded):
+        self.path = path
+        self.offset = offset
+        self.properties = properties
+        self.labels = labels and tuple(labels.split('\n')) or ()
+        self.uploaded = uploaded
+
+class DedupIndex(object):
+    r"""Persistent index of messages across folders and runs.
+    
+    Messages are keyed by normalized Message-ID, or by a digest of the 
+    content if they have none. Each key is uploaded once, from the first
+    folder it was indexed in, with the union of the labels and properties
+    of every folder it appears in.
+    
+    The index is an SQLite table, so memory use is bounded by its page
+    cache however many messages there are. A Bloom filter saved next to
+    it lets indexing insert the (usual) new keys without a lookup.
+    
+    An index `shared` between processes keeps uploaded marks in memory
+    and writes them in one short transaction every SHARED_COMMIT_INTERVAL
+    marks or SHARED_COMMIT_SECONDS, so that no process holds the
+    database's write lock while it uploads. The database is in WAL mode,
+    so lookups do not wait for a writer either.
+    
+    """
+    
+    BLOOM_SUFFIX = '.bloom'
+    COMMIT_INTERVAL = 10000
+    # marks of a shared index are written at least this often
+    SHARED_COMMIT_INTERVAL = 100
+    SHARED_COMMIT_SECONDS = 1.0
+    HEADER_LIMIT = 2**16
+    MESSAGE_ID = re.compile(r'^message-id:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.I | re.M)
+    
+    def __init__(self, path, capacity=10**7, bloom=True, shared=False):
+        self.path = path
+        self.shared = shared
+        self.database = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # keys, paths and labels are stored as the byte strings they are
+        self.database.text_factory = str
+        self.database.execute('PRAGMA journal_mode=WAL')
+        self.database.execute('CREATE TABLE IF NOT EXISTS messages ('
+                              'key TEXT PRIMARY KEY, '
+                              'path TEXT, '
+                              'offset INTEGER, '
+                              'properties INTEGER, '
+                              'labels TEXT, '
+                              'uploaded INTEGER DEFAULT 0)')
+        self.database.commit()
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.marks = []
+        self.flushed = time.time()
+        self.bloom = None
+        if bloom:
+            self.bloom = BloomFilter(capacity)
+            count = self.database.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+            bloom_path = path + self.BLOOM_SUFFIX
+            if not (os.path.exists(bloom_path) 
+                    and self.bloom.load(bloom_path) 
+                    and self.bloom.count == count):
+                self.bloom = BloomFilter(capacity)
+                for (key,) in self.database.execute('SELECT key FROM messages'):
+                    self.bloom.add(key)
+    
+    def key(self, message):
+        r"""Returns the dedup key of a message, parsing only its headers."""
+        headers = str(buffer(message, 0, self.HEADER_LIMIT))
+        end = headers.find('\n\n')
+        if end >= 0:
+            headers = headers[:end]
+        match = self.MESSAGE_ID.search(headers)
+        if match:
+            value = ''.join(match.group(1).split())
+            if value.startswith('<') and '>' in value:
+                value = value[1:value.index('>')]
+            if value:
+                return 'id:' + value
+        return 'sha1:' + hashlib.sha1(message).hexdigest()
+    
+    def lookup(self, key):
+        self.lock.acquire()
+        try:
+            row = self.database.execute('SELECT path, offset, properties, labels, uploaded '
+                                        'FROM messages WHERE key = ?', 
+                                        (key,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return DedupEntry(*row)
+    
+    def add(self, key, path, offset, properties, labels):
+        r"""Indexes a message found in a folder.
+        
+        Returns:
+            True if the key was already indexed from another location.
+        """
+        labels = tuple(labels or ())
+        entry = None
+        if self.bloom is None or key in self.bloom:
+            entry = self.lookup(key)
+        self.lock.acquire()
+        try:
+            if entry is None:
+                self.database.execute('INSERT INTO messages (key, path, offset, properties, labels) '
+                                      'VALUES (?, ?, ?, ?, ?)',
+                                      (key, path, offset, properties, '\n'.join(labels)))
+                if self.bloom is not None:
+                    self.bloom.add(key)
+                duplicate = False
+            else:
+                duplicate = (entry.path, entry.offset) != (path, offset)
+                merged = entry.labels + tuple([l for l in labels if l not in entry.labels])
+                if duplicate and not entry.uploaded and (
+                    merged != entry.labels or properties | entry.properties != entry.properties):
+                    self.database.execute('UPDATE messages SET properties = ?, labels = ? WHERE key = ?',
+                                          (properties | entry.properties, '\n'.join(merged), key))
+            self.changed()
+        finally:
+            self.lock.release()
+        return duplicate
+    
+    def uploaded(self, key):
+        self.lock.acquire()
+        try:
+            if self.shared:
+                self.marks.append((key,))
+                if (len(self.marks) >= self.SHARED_COMMIT_INTERVAL 
+                    or time.time() - self.flushed >= self.SHARED_COMMIT_SECONDS):
+                    self.flush()
+            else:
+                self.database.execute('UPDATE messages SET uploaded = 1 WHERE key = ?', 
+                                      (key,))
+                self.changed()
+        finally:
+            self.lock.release()
+    
+    def flush(self):
+        if self.marks:
+            self.database.executemany('UPDATE messages SET uploaded = 1 WHERE key = ?', 
+                                      self.marks)
+            self.marks = []
+        self.database.commit()
+        self.uncommitted = 0
+        self.flushed = time.time()
+    
+    def changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.database.commit()
+            self.uncommitted = 0
+    
+    def commit(self):
+        self.lock.acquire()
+        try:
+            self.flush()
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.flush()
+            self.database.close()
+            if self.bloom is not None:
+                self.bloom.save(self.path + self.BLOOM_SUFFIX)
+        finally:
+            self.lock.release()
+
+# Keys for MessageIndex.schedule
+SCHEDULE_ORDERS = ('inbox', 'newest', 'oldest', 'smallest')
+
+# Messages scheduled at a time; within each window, a folder's messages are
+# uploaded together
+SCHEDULE_WINDOW = 1000
+
+DATE_PATTERN = re.compile(r'^Date:[ \t]*(.+)$', re.M | re.I)
+
+# The usual form of a Date header, parsed without email.utils
+RFC2822_DATE = re.compile(r'^(?:\w{3}, *)?(\d{1,2}) (\w{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})')
+MONTHS = dict([(name, i + 1) for i, name in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                      'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])])
+
+def parse_date(date):
+    r"""Returns the time of an RFC 2822 date, or None if it cannot be parsed."""
+    match = RFC2822_DATE.match(date)
+    if match is not None and match.group(2) in MONTHS:
+        day, month, year, hour, minute, second, sign, zone_hours, zone_minutes = match.groups()
+        zone = int(zone_hours) * 3600 + int(zone_minutes) * 60
+        if sign == '+':
+            zone = -zone
+        return calendar.timegm((int(year), MONTHS[month], int(day),
+                                int(hour), int(minute), int(second))) + zone
+    parsed = email.utils.parsedate_tz(date)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def message_date(header):
+    r"""Returns the time of a message from its Date header, or failing that
+    from its mbox separator line, or 0 if neither can be parsed."""
+    match = DATE_PATTERN.search(header)
+    if match is not None:
+        date = parse_date(match.group(1).strip())
+        if date is not None:
+            return date
+    if header.startswith(MboxReader.SEPARATOR):
+        fields = header.split('\n', 1)[0].split(None, 2)
+        if len(fields) == 3:
+            date = parse_date(fields[2])
+            if date is not None:
+                return date
+    return 0.0
+
+class MessageIndex(object):
+    r"""Compact index of (folder, offset, date, size) for every message.
+    
+    Only message boundaries and header blocks are read to build it, and 
+    entries are kept in arrays rather than as objects, so that mailboxes 
+    of millions of messages can be indexed in memory.
+    
+    Example Usage:
+    
+        >>> index = MessageIndex()
+        >>> for path in find_folders(input):
+        ...   index.add(path)
+        >>> for path, offsets in index.schedule(['inbox', 'newest']):
+        ...   upload_folder(path, service, options, offsets=offsets)
+    
+    """
+    
+    def __init__(self):
+        self.paths = []
+        self.inbox = []
+        self.streamed = []
+        self.starts = []
+        self.folders = array.array('i')
+        self.offsets = array.array('l')
+        self.dates = array.array('d')
+        self.sizes = array.array('l')
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def add(self, path):
+        r"""Indexes the messages of a folder and returns how many there are."""
+        folder = len(self.paths)
+        start = len(self.offsets)
+        reader = open_folder(path)
+        count = 0
+        try:
+            for offset, size, header in reader.headers():
+                self.folders.append(folder)
+                self.offsets.append(offset)
+                self.dates.append(message_date(header))
+                self.sizes.append(size)
+                count += 1
+        finally:
+            reader.close()
+        self.paths.append(path)
+        self.starts.append(start)
+        self.inbox.append(bool(parse_folder(path)[1] & migration.MAIL_INBOX))
+        self.streamed.append(isinstance(reader, CompressedMboxReader))
+        return count
+    
+    def key(self, order):
+        r"""Returns the sort key function for one of SCHEDULE_ORDERS, which
+        maps a message's position in the index to a single number."""
+        folders, dates, sizes, inbox = self.folders, self.dates, self.sizes, self.inbox
+        # messages without a date go last either way
+        last = float('inf')
+        keys = { 'inbox' : lambda i: not inbox[folders[i]],
+                 'newest' : lambda i: dates[i] and -dates[i] or last,
+                 'oldest' : lambda i: dates[i] or last,
+                 'smallest' : lambda i: sizes[i] }
+        return keys[order]
+    
+    def sort(self, orders):
+        r"""Returns an array of positions in the index, sorted by a sequence
+        of SCHEDULE_ORDERS; ties are broken by folder and then file order.
+        
+        Rather than by a tuple key per message, positions are sorted once
+        per order, least significant first; each sort is stable and the
+        positions start out in folder and file order.
+        """
+        order = range(len(self.offsets))
+        for name in reversed(orders):
+            order.sort(key=self.key(name))
+        return array.array('l', order)
+    
+    def schedule(self, orders, window=SCHEDULE_WINDOW):
+        r"""Yields 2-tuples of (folder path, offsets) in the given order.
+        
+        Messages are sorted by `orders`, then taken `window` at a time and
+        grouped by folder, so each group can be uploaded as one stream. 
+        Compressed folders cannot be read out of order cheaply, so each is 
+        scheduled whole, in file order, where its first message falls.
+        """
+        order = self.sort(orders)
+        scheduled = set()
+        for start in xrange(0, len(order), window):
+            groups = {}
+            sequence = []
+            for i in order[start:start + window]:
+                folder = self.folders[i]
+                if folder in scheduled:
+                    continue
+                if folder not in groups:
+                    groups[folder] = []
+                    sequence.append(folder)
+                    if self.streamed[folder]:
+                        scheduled.add(folder)
+                        end = (self.starts[folder + 1:] or [len(self.offsets)])[0]
+                        groups[folder] = self.offsets[self.starts[folder]:end].tolist()
+                        continue
+                groups[folder].append(self.offsets[i])
+            for folder in sequence:
+                yield self.paths[folder], groups[folder]
+
+##############################################################################
+
 def upload_test(service, options):
     message = str(migration.SAMPLE_EMAIL)
     properties = migration.MAIL_UNREAD | migration.MAIL_INBOX | migration.MAIL_STARRED
@@ -67,11 +1112,28 @@ def upload_test(service, options):
 
 ##############################################################################
 
-def upload_folder(path, service, options):
-    sys.stdout.write("Opening mbox file: %s\n" % path)
-        
-    # extract properties and labels from file name
-    folder = os.path.basename(path).rsplit('.', 1)[0]
+def strip_failure(message):
+    r"""Returns a message (string or buffer) without the FAILURE_HEADER 
+    line put in front of it by FailureSink."""
+    prefix = '%s: ' % FAILURE_HEADER
+    if message[:len(prefix)] != prefix:
+        return message
+    end = str(message[:4096]).find('\n')
+    if end < 0:
+        end = str(message).find('\n')
+        if end < 0:
+            return ''
+    return buffer(message, end + 1)
+
+def parse_folder(path):
+    r"""Extracts properties and labels from an mbox file or Maildir name.
+    
+    Returns:
+        A 3-tuple of (folder name, properties, labels or None).
+    """
+    folder = os.path.basename(os.path.normpath(path))
+    if not os.path.isdir(path):
+        folder = folder[:len(folder) - len(folder_suffix(folder))].rsplit('.', 1)[0]
     labels = None
     properties = 0
     if folder != UNLABELED_FOLDER:
@@ -80,77 +1142,693 @@ def upload_folder(path, service, options):
         while i < len(labels):
             label = labels[i]
             if label in FLAGS:
-                flag = FLAGS[label]
-                properties |= flag
-                if options.verbose:
-                    print "Flag:", migration.MAIL_PROPERTIES[flag]
+                properties |= FLAGS[label]
                 del labels[i]
             else:
-                if options.verbose:
-                    print "Label:", label
                 i += 1
+    return folder, properties, labels
+
+def index_folder(path, dedup, options):
+    r"""Adds the messages of an mbox file to a dedup index.
+    
+    Returns:
+        A 2-tuple of (messages indexed, duplicates of earlier messages).
+    """
+    folder, properties, labels = parse_folder(path)
+    path = os.path.abspath(path)
+    mbox = open_folder(path)
+    count = duplicates = 0
+    try:
+        for offset, message in mbox:
+            count += 1
+            if dedup.add(dedup.key(message), path, offset, properties, labels):
+                duplicates += 1
+    finally:
+        mbox.close()
+    if options.verbose:
+        print 'Indexed %s: %d messages, %d duplicates' % (path, count, duplicates)
+    return count, duplicates
+
+def copy_dedup_index(path, directory):
+    r"""Copies a dedup index and its Bloom filter, if they exist, into 
+    `directory`, and returns the path of the copy."""
+    copy = os.path.join(directory, os.path.basename(path))
+    for suffix in ('', '-wal', DedupIndex.BLOOM_SUFFIX):
+        if os.path.exists(path + suffix):
+            shutil.copyfile(path + suffix, copy + suffix)
+    return copy
+
+def upload_folder(path, service, options, username=None, domain=None, concurrency=None, dedup=None,
+                  offsets=None, journal=None):
+    r"""Uploads one mbox file, compressed mbox file or Maildir (see open_folder).
+    
+    If `offsets` is given, only the messages at those offsets are uploaded,
+    in that order, as scheduled by MessageIndex. A `journal` may be given
+    to keep it open across several calls for the same folder.
+    
+    With a dedup index, messages already uploaded or to be uploaded from 
+    another folder are skipped, and messages appearing in several folders
+    are uploaded with the merged labels and properties of all of them.
+    
+    With options.retry_failed, the messages that previously failed to 
+    upload from the mbox file are uploaded instead. The failed mbox is 
+    moved aside (with RETRY_SUFFIX) while it is read, so that messages 
+    failing again are collected afresh, and removed once it has been read.
+    
+    Returns:
+        A 3-tuple of (messages read, kB uploaded, messages failed).
+    """
+    if offsets is None:
+        sys.stdout.write("Opening mbox file: %s\n" % path)
+    else:
+        sys.stdout.write("Uploading %d messages from: %s\n" % (len(offsets), path))
+        
+    # extract properties and labels from file name
+    folder, properties, labels = parse_folder(path)
+    if options.verbose:
+        for flag in migration.MAIL_FLAGS:
+            if flag & properties:
+                print "Flag:", migration.MAIL_PROPERTIES[flag]
+        for label in labels or ():
+            print "Label:", label
         
     failed_file = '%s%s%s.mbox' % (FAILED_PREFIX,
                                    FOLDER_DELIM, 
                                    folder)
+    if username:
+        failed_file = '%s%s%s%s%s.mbox' % (FAILED_PREFIX,
+                                           FOLDER_DELIM,
+                                           username,
+                                           FOLDER_DELIM,
+                                           folder)
     if options.verbose:
         print 'Messages that fail to upload will be written to:', failed_file
-    failed_mbox = None
-            
-    mbox = mailbox.mbox(path)
-    total = len(mbox)
-    progress_format = 'Message %d/' + str(total) + ': (%d kB) ...'
-    count = 0
-    total_size = 0
-    failed = None
-    for mailkey in mbox.iterkeys():
-        count += 1
-        message = mbox.get_string(mailkey)
-        size = len(message) / 1000
-        if options.verbose:
-            print progress_format % (count, size)
+    failed_mbox = FailureSink(failed_file)
+    
+    source = path
+    if options.retry_failed:
+        source = failed_file + RETRY_SUFFIX
+        if not os.path.exists(source):
+            if options.dryrun:
+                source = failed_file
+            elif os.path.exists(failed_file):
+                os.rename(failed_file, source)
+                if os.path.exists(failed_file + FailureSink.SUFFIX):
+                    os.rename(failed_file + FailureSink.SUFFIX, source + FailureSink.SUFFIX)
+        if not os.path.exists(source):
+            sys.stdout.write("No failed messages to retry in: %s\n" % failed_file)
+            return 0, 0, 0
+        sys.stdout.write("Retrying failed messages from: %s\n" % source)
         
-        if not options.dryrun:
-            messages = message,
-            failed = service.upload_messages(messages, properties, labels)
-            if failed and failed_mbox is None:
-                failed_mbox = mailbox.mbox(failed_file, create=True)
-            for msg, why in failed:
+    mbox = open_folder(source)
+    own_journal = journal is None
+    if own_journal and not options.dryrun:
+        journal = Journal(source + Journal.SUFFIX, options.resume)
+        if options.resume and len(journal):
+            mbox.offset = journal.resume(mbox.find(0))
+            if options.verbose:
+                print 'Resuming after %d uploaded messages at offset %d' % (len(journal), mbox.offset)
+    progress_format = 'Message %d: (%d kB) ... %d%%'
+    sizes = [0, 0]
+    merged = {}
+    duplicates = [0]
+    location = (os.path.abspath(path), labels and tuple(labels) or (), properties)
+    
+    def read_messages(messages, merging=False):
+        for offset, message in messages:
+            if journal is not None and offset in journal:
+                continue
+            key = None
+            if dedup is not None:
+                key = dedup.key(message)
+                entry = dedup.lookup(key)
+                if entry is not None:
+                    if entry.uploaded or (entry.path, entry.offset) != (location[0], offset):
+                        duplicates[0] += 1
+                        continue
+                    if not merging and (entry.labels, entry.properties) != location[1:]:
+                        merged.setdefault((entry.properties, entry.labels), []).append(offset)
+                        continue
+            if options.retry_failed:
+                message = strip_failure(message)
+            size = len(message) / 1000
+            sizes[0] += 1
+            sizes[1] += size
+            if options.verbose:
+                print progress_format % (sizes[0], size, mbox.progress)
+            # tagged with where it was read from, for acknowledge()
+            yield (offset, mbox.position, key), message
+    
+    def read_merged(offsets):
+        for offset in offsets:
+            message, next = mbox.read(offset)
+            yield offset, message
+    
+    def acknowledge(item):
+        (offset, stop, key), message = item
+        journal.record(offset, stop)
+        if key is not None:
+            dedup.uploaded(key)
+    
+    messages = mbox
+    if offsets is not None:
+        messages = read_merged(offsets)
+    
+    failed = []
+    failed_size = 0
+    try:
+        if options.dryrun:
+            oversize = 0
+            streams = [read_messages(messages)]
+            while streams:
+                for tag, message in streams.pop(0):
+                    if options.max_size and len(message) > options.max_size:
+                        oversize += 1
+                # count the messages that would go up with merged labels too
+                streams.extend([read_messages(read_merged(offsets), True) 
+                                for offsets in merged.values()])
+                merged.clear()
+            if oversize:
+                print '%d messages are over the %d byte limit' % (oversize, options.max_size)
+            return sizes[0], sizes[1], oversize
+        
+        uploads = [service.upload_stream(read_messages(messages), properties, labels, 
+                                         username, domain, concurrency,
+                                         callback=acknowledge, tagged=True)]
+        while uploads:
+            for (tag, msg), why in uploads.pop(0):
+                failed.append(why)
                 if options.verbose:
                     print 'ERROR:', str(why)
-                obj = email.message_from_string(msg)
-                obj[FAILURE_HEADER] = str(why)
-                failed_mbox.add(obj)
-                failed_mbox.flush()
-        if not failed:
-            total_size += size
+                failed_mbox.add(msg, why)
+                failed_size += len(msg) / 1000
+            # messages also found in other folders go up with the merged labels
+            for (merged_properties, merged_labels), offsets in sorted(merged.items()):
+                uploads.append(service.upload_stream(read_messages(read_merged(offsets), True),
+                                                     merged_properties, list(merged_labels),
+                                                     username, domain, concurrency,
+                                                     callback=acknowledge, tagged=True))
+            merged.clear()
+        total_size = sizes[1] - failed_size
+    finally:
+        failed_mbox.close()
+        if journal is not None and own_journal:
+            journal.close()
+        mbox.close()
+    
+    if options.retry_failed and not options.dryrun:
+        for file in source, source + FailureSink.SUFFIX, source + Journal.SUFFIX:
+            if os.path.exists(file):
+                os.remove(file)
     
     if options.verbose:
+        if duplicates[0]:
+            print 'Skipped %d duplicate messages' % duplicates[0]
         print 'Successful data upload: %d kB' % total_size
+    return sizes[0], total_size, len(failed)
         
 ##############################################################################
 
-def upload(options):
-    service = migration.EmailMigrationService(options.email, options.password)
-    service.authenticate()
+def find_folders(path):
+    r"""Returns the folders to upload from a file or directory path.
     
-    if options.test:
-        upload_test(service, options)
-        return
-    
-    path = options.input
+    A directory is either a Maildir or contains mbox files (possibly
+    compressed, e.g. INBOX.mbox.gz) and Maildirs.
+    """
     folders = []
-    if os.path.isdir(path):
-        for file in os.listdir(path):
-            if not file.startswith(FAILED_PREFIX) and file.endswith('.mbox'):
+    if MaildirReader.is_maildir(path):
+        folders.append(os.path.normpath(path))
+    elif os.path.isdir(path):
+        for file in sorted(os.listdir(path)):
+            if file.startswith(FAILED_PREFIX):
+                continue
+            name = file[:len(file) - len(folder_suffix(file))]
+            if name.endswith('.mbox') or MaildirReader.is_maildir(os.path.join(path, file)):
                 folders.append(os.path.join(path, file))
     elif os.path.isfile(path):
         folders.append(path)
     else:
         raise RuntimeError('Input path must be a directory or file: %s' % path)
+    return folders
 
+def upload_scheduled(service, options, folders, dedup=None):
+    r"""Uploads folders message by message in the order of options.order.
+    
+    A MessageIndex of all the folders is built first, from their headers
+    only; message bodies are then read from the folders as they are sent.
+    Each folder's journal stays open across the batches scheduled from it.
+    """
+    index = MessageIndex()
+    start = time.time()
     for path in folders:
-        upload_folder(path, service, options)
+        count = index.add(path)
+        if options.verbose:
+            print 'Indexed %s: %d messages' % (path, count)
+    sys.stdout.write('Scheduled %d messages from %d folders in %.1f s\n' 
+                     % (len(index), len(folders), time.time() - start))
+    
+    journals = {}
+    totals = [0, 0, 0]
+    try:
+        for path, offsets in index.schedule(options.order.split(',')):
+            journal = journals.get(path)
+            if journal is None and not options.dryrun:
+                journal = journals[path] = Journal(path + Journal.SUFFIX, options.resume)
+            result = upload_folder(path, service, options, dedup=dedup, 
+                                   offsets=offsets, journal=journal)
+            for i, value in enumerate(result):
+                totals[i] += value
+    finally:
+        for journal in journals.values():
+            journal.close()
+    sys.stdout.write('Uploaded %d kB from %d messages; %d messages failed\n'
+                     % (totals[1], totals[0], totals[2]))
+
+##############################################################################
+
+def read_manifest(path):
+    r"""Parses a domain migration manifest.
+    
+    Each line names a user and the mbox file or directory to upload for
+    them, separated by whitespace. The user is either a username in the
+    administrator's domain or a full email address. Blank lines and lines
+    starting with '#' are ignored, and relative paths are relative to the 
+    manifest.
+    
+    Returns:
+        A list of 3-tuples of (username, domain, path); domain may be None.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    users = []
+    f = open(path)
+    try:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise RuntimeError('%s:%d: expected USER PATH' % (path, number + 1))
+            user, input = fields
+            domain = None
+            if '@' in user:
+                user, domain = user.split('@', 1)
+            users.append((user, domain, os.path.join(base, input)))
+    finally:
+        f.close()
+    return users
+
+def upload_domain(service, options):
+    r"""Uploads the mailboxes of all users in the manifest in parallel.
+    
+    The service's concurrency is the global cap on requests in flight;
+    each user is allowed at most options.user_concurrency of them, so 
+    that many users' mailboxes migrate side by side.
+    """
+    users = read_manifest(options.manifest)
+    per_user = min(options.user_concurrency, options.concurrency)
+    work = Queue.Queue()
+    for user in users:
+        work.put(user)
+    failed = []
+    
+    def worker():
+        while True:
+            try:
+                username, domain, path = work.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                for folder in find_folders(path):
+                    upload_folder(folder, service, options, username, domain, per_user)
+            except Exception as e:
+                sys.stderr.write('Error migrating %s: %s\n' % (username, e))
+                failed.append((username, e))
+    
+    workers = [threading.Thread(target=worker) 
+               for i in xrange(max(1, options.concurrency / per_user))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    
+    if failed:
+        sys.stderr.write('Migration failed for %d of %d users: %s\n' 
+                         % (len(failed), len(users), 
+                            ', '.join([username for username, e in failed])))
+
+# Per-process state of upload_jobs workers
+job_service = None
+job_options = None
+job_reporter = None
+job_dedup = None
+
+def init_job(options, token, issued, dedup_path):
+    global job_service, job_options, job_reporter, job_dedup
+    rate = options.rate
+    if rate:
+        rate /= options.jobs
+    # connections must not be shared with the parent process
+    pool = migration.ConnectionPool(metrics=migration.Metrics())
+    job_service = migration.EmailMigrationService(options.email, 
+                                                  options.password,
+                                                  options.concurrency,
+                                                  pool=pool,
+                                                  rate=rate,
+                                                  retries=options.retries,
+                                                  token_cache=options.token_cache,
+                                                  max_size=options.max_size,
+                                                  compress=options.compress)
+    job_service.tokens.set(token, issued)
+    job_options = options
+    if dedup_path:
+        job_dedup = DedupIndex(dedup_path, bloom=False, shared=True)
+    job_reporter = start_reporter(options, pool.metrics, '.%d' % os.getpid())
+
+def run_job(path):
+    try:
+        result, error = upload_folder(path, job_service, job_options, dedup=job_dedup), None
+    except Exception as e:
+        result, error = None, '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        if job_reporter is not None:
+            job_reporter.flush()
+        if job_dedup is not None:
+            job_dedup.commit()
+    return path, result, error, (os.getpid(), job_service.metrics.snapshot())
+
+def upload_jobs(service, options, folders, dedup_path=None):
+    r"""Uploads folders in parallel across options.jobs worker processes.
+    
+    Each worker process has its own connection pool and reuses the 
+    token of the already authenticated service; with --token-cache, the
+    workers also share its refreshes. Progress and failures are
+    collected by the parent as each folder completes.
+    
+    Each worker writes its own metrics file, suffixed with its pid; the
+    parent adds up the workers' metrics as folders complete and writes
+    the totals for the whole run to the --metrics-file itself.
+    """
+    metrics = migration.Metrics()
+    reporter = None
+    if options.metrics_file:
+        reporter = migration.Reporter([migration.PrometheusSink(options.metrics_file)],
+                                      options.metrics_interval, metrics)
+        reporter.start()
+    snapshots = {}
+    pool = multiprocessing.Pool(options.jobs, init_job, 
+                                (options, service.token, service.tokens.issued, dedup_path))
+    totals = [0, 0, 0]
+    errors = []
+    try:
+        done = 0
+        for path, result, error, (pid, snapshot) in pool.imap_unordered(run_job, folders):
+            done += 1
+            metrics.add(snapshot, snapshots.get(pid))
+            snapshots[pid] = snapshot
+            if error:
+                errors.append(path)
+                sys.stderr.write('Error uploading %s: %s\n' % (path, error))
+                continue
+            for i, value in enumerate(result):
+                totals[i] += value
+            sys.stdout.write('Folder %d/%d done: %s (%d messages, %d kB, %d failed)\n' 
+                             % ((done, len(folders), path) + result))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if reporter is not None:
+            reporter.stop()
+    sys.stdout.write('Uploaded %d kB from %d messages in %d folders; %d messages and %d folders failed\n'
+                     % (totals[1], totals[0], len(folders), totals[2], len(errors)))
+
+##############################################################################
+
+# Upper bounds of the message size histogram buckets
+PLAN_BUCKETS = [4 * 2**10, 16 * 2**10, 64 * 2**10, 256 * 2**10, 
+                2**20, 4 * 2**20, 16 * 2**20]
+
+def format_size(size):
+    for unit, scale in (('GB', 2**30), ('MB', 2**20), ('kB', 2**10)):
+        if size >= scale:
+            return '%.1f %s' % (float(size) / scale, unit)
+    return '%d B' % size
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return '%dd %dh %dm' % (days, hours, minutes)
+    return '%dh %dm %ds' % (hours, minutes, seconds)
+
+def format_histogram(histogram):
+    bounds = ['<%s' % format_size(bound).replace('.0 ', '') for bound in PLAN_BUCKETS]
+    bounds.append('>=%s' % format_size(PLAN_BUCKETS[-1]).replace('.0 ', ''))
+    return ', '.join(['%s: %d' % (bound, count) 
+                      for bound, count in zip(bounds, histogram) if count])
+
+def plan_folder(args):
+    r"""Scans one folder for message boundaries and sizes.
+    
+    Returns:
+        A dict with the folder's name, properties, labels, message count,
+        total and largest size, size histogram (see PLAN_BUCKETS), number
+        of messages over max_size and scan time; or with 'error' set.
+    """
+    path, max_size = args
+    start = time.time()
+    folder, properties, labels = parse_folder(path)
+    result = { 'path' : path, 
+             'folder' : folder, 
+             'properties' : properties, 
+             'labels' : labels or [],
+             'count' : 0, 
+             'bytes' : 0, 
+             'largest' : 0, 
+             'oversize' : 0,
+             'histogram' : [0] * (len(PLAN_BUCKETS) + 1),
+             'error' : None }
+    try:
+        reader = open_folder(path)
+        try:
+            histogram = result['histogram']
+            for size in reader.sizes():
+                result['count'] += 1
+                result['bytes'] += size
+                histogram[bisect.bisect_right(PLAN_BUCKETS, size)] += 1
+                if size > result['largest']:
+                    result['largest'] = size
+                if max_size and size > max_size:
+                    result['oversize'] += 1
+        finally:
+            reader.close()
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['elapsed'] = time.time() - start
+    return result
+
+def measured_throughput(path):
+    r"""Returns the (messages/s, bytes/s) of the last run that wrote the 
+    metrics file `path`, or None.
+    
+    With --jobs, the parent writes the totals of all workers to `path`,
+    so the per-worker files beside it (of this run or earlier ones) are
+    not read.
+    """
+    values = {}
+    try:
+        f = open(path, 'r')
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and not line.startswith('#'):
+                    values[fields[0]] = float(fields[1])
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    elapsed = values.get('migration_elapsed_seconds')
+    messages = values.get('migration_messages_uploaded_total', 0)
+    if not elapsed or not messages:
+        return None
+    return messages / elapsed, values.get('migration_bytes_sent_total', 0) / elapsed
+
+def plan(options):
+    r"""Reports what a migration would upload, and how long it would take.
+    
+    Every folder is scanned in parallel for message boundaries and sizes 
+    only. The ETA is projected from --throughput (and --bandwidth) if 
+    given, otherwise from the metrics file of an earlier run, otherwise
+    from --rate.
+    """
+    folders = []
+    if options.manifest:
+        for username, domain, path in read_manifest(options.manifest):
+            folders.extend(find_folders(path))
+    else:
+        folders = find_folders(options.input)
+    if not folders:
+        sys.stdout.write('No folders found\n')
+        return
+    
+    start = time.time()
+    processes = min(len(folders), options.jobs > 1 and options.jobs or multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes)
+    try:
+        plans = pool.map(plan_folder, [(path, options.max_size) for path in folders], 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = time.time() - start
+    
+    totals = { 'count' : 0, 'bytes' : 0, 'largest' : 0, 'oversize' : 0,
+               'histogram' : [0] * (len(PLAN_BUCKETS) + 1) }
+    for result in plans:
+        if result['error']:
+            sys.stdout.write('%s: %s\n' % (result['path'], result['error']))
+            continue
+        flags = [name for name, flag in sorted(FLAGS.items()) if flag & result['properties']]
+        sys.stdout.write('%s: %d messages, %s, largest %s%s\n'
+                         % (result['path'], result['count'], format_size(result['bytes']),
+                            format_size(result['largest']),
+                            result['oversize'] and ', %d over the size limit' % result['oversize'] or ''))
+        sys.stdout.write('    flags: %s; labels: %s\n' 
+                         % (', '.join(flags) or '-', ', '.join(result['labels']) or '-'))
+        if result['count']:
+            sys.stdout.write('    sizes: %s\n' % format_histogram(result['histogram']))
+        for name in 'count', 'bytes', 'oversize':
+            totals[name] += result[name]
+        totals['largest'] = max(totals['largest'], result['largest'])
+        for i, count in enumerate(result['histogram']):
+            totals['histogram'][i] += count
+    
+    sys.stdout.write('Total: %d messages, %s in %d folders; %d over the size limit\n'
+                     % (totals['count'], format_size(totals['bytes']), len(folders), totals['oversize']))
+    if totals['count']:
+        sys.stdout.write('    sizes: %s\n' % format_histogram(totals['histogram']))
+    sys.stdout.write('Scanned in %.1f s (%s/s)\n' % (elapsed, format_size(totals['bytes'] / max(elapsed, 1e-6))))
+    
+    rates = None
+    source = None
+    if options.throughput:
+        rates = (options.throughput, options.bandwidth and options.bandwidth * 2**20 or 0)
+        source = 'configured'
+    elif options.metrics_file and measured_throughput(options.metrics_file):
+        rates = measured_throughput(options.metrics_file)
+        source = 'measured in %s' % options.metrics_file
+    elif options.rate:
+        rates = (options.rate, 0)
+        source = '--rate'
+    if rates is None:
+        sys.stdout.write('ETA: unknown; give --throughput, or --metrics-file of an earlier run\n')
+        return
+    count = totals['count'] - totals['oversize']
+    seconds = count / rates[0]
+    if rates[1]:
+        seconds = max(seconds, totals['bytes'] / rates[1])
+    sys.stdout.write('ETA: %s at %.1f messages/s%s (%s)\n' 
+                     % (format_duration(seconds), rates[0], 
+                        rates[1] and ', %s/s' % format_size(rates[1]) or '', source))
+
+##############################################################################
+
+def start_reporter(options, metrics=None, suffix=''):
+    r"""Starts periodic metrics reporting as configured, or returns None."""
+    sinks = []
+    if options.progress:
+        sinks.append(migration.ProgressSink(sys.stdout))
+    if options.metrics_file:
+        sinks.append(migration.PrometheusSink(options.metrics_file + suffix))
+    if options.statsd:
+        host, port = options.statsd.rsplit(':', 1)
+        sinks.append(migration.StatsdSink(host, int(port)))
+    if not sinks:
+        return None
+    reporter = migration.Reporter(sinks, options.metrics_interval, metrics)
+    reporter.start()
+    return reporter
+
+def upload(options):
+    if options.plan:
+        plan(options)
+        return
+    
+    service = migration.EmailMigrationService(options.email, 
+                                              options.password,
+                                              options.concurrency,
+                                              rate=options.rate,
+                                              retries=options.retries,
+                                              token_cache=options.token_cache,
+                                              max_size=options.max_size,
+                                              compress=options.compress)
+    service.authenticate()
+    
+    if options.test:
+        upload_test(service, options)
+        return
+    
+    if options.manifest:
+        reporter = start_reporter(options, service.metrics)
+        try:
+            upload_domain(service, options)
+        finally:
+            if reporter is not None:
+                reporter.stop()
+        return
+    
+    folders = find_folders(options.input)
+    dedup = None
+    dedup_path = options.dedup
+    scratch = None
+    if options.dedup and options.dryrun:
+        # a dry run indexes into a copy of the index, removed afterwards
+        scratch = tempfile.mkdtemp(prefix='mbox2gdata')
+        dedup_path = copy_dedup_index(options.dedup, scratch)
+    try:
+        if dedup_path:
+            dedup = DedupIndex(dedup_path, options.dedup_capacity)
+            totals = [0, 0]
+            try:
+                for path in folders:
+                    for i, count in enumerate(index_folder(path, dedup, options)):
+                        totals[i] += count
+            except:
+                dedup.close()
+                raise
+            sys.stdout.write('Indexed %d messages, %d duplicates\n' % tuple(totals))
+        
+        try:
+            if options.jobs > 1:
+                if dedup is not None:
+                    dedup.close()
+                    dedup = None
+                upload_jobs(service, options, folders, dedup_path)
+                return
+            
+            reporter = start_reporter(options, service.metrics)
+            try:
+                if options.order:
+                    upload_scheduled(service, options, folders, dedup)
+                else:
+                    for path in folders:
+                        upload_folder(path, service, options, dedup=dedup)
+            finally:
+                if reporter is not None:
+                    reporter.stop()
+        finally:
+            if dedup is not None:
+                dedup.close()
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, True)
 
 ##############################################################################
 ##############################################################################
@@ -169,6 +1847,12 @@ INBOX, STARRED, UNREAD, TRASH, DRAFT, SENT. The keyword 'all' will result
 in those messages being uploaded without any labels or properties.
 For example: All messages in the file 'INBOX-STARRED-priority.mbox' will
 be uploaded to your Inbox, starred, and labeled with 'priority'.
+mbox files may be compressed with gzip, bzip2, xz or zstd (e.g. 'INBOX.mbox.gz')
+and are decompressed as they are read. Maildir directories are named 
+the same way as mbox files, e.g. 'INBOX-STARRED-priority/'.
+A domain administrator can migrate many users at once with the '-m' option,
+naming a manifest file that lists a user and an mbox file or directory
+on each line.
 """
 
     optparser = optparse.OptionParser(usage=usage, description=description)
@@ -177,7 +1861,91 @@ be uploaded to your Inbox, starred, and labeled with 'priority'.
                          metavar='PATH',
                          dest="input",
                          default = os.getcwd(),
-                         help='mbox file, or directory containing mbox files')
+                         help='mbox file or Maildir, or directory containing mbox files and Maildirs')
+    optparser.add_option('-c',
+                         '--concurrency',
+                         metavar='N',
+                         dest="concurrency",
+                         type="int",
+                         default=migration.UPLOAD_CONCURRENCY,
+                         help='maximum number of messages uploading at once')
+    optparser.add_option('-j',
+                         '--jobs',
+                         metavar='N',
+                         dest="jobs",
+                         type="int",
+                         default=1,
+                         help='number of processes uploading mbox files in parallel; --concurrency applies to each')
+    optparser.add_option('-m',
+                         '--manifest',
+                         metavar='FILE',
+                         dest="manifest",
+                         default=None,
+                         help='migrate many users as a domain administrator; each line of FILE is a username or email address and an mbox file or directory')
+    optparser.add_option('--user-concurrency',
+                         metavar='N',
+                         dest="user_concurrency",
+                         type="int",
+                         default=1,
+                         help='with --manifest, maximum number of messages uploading at once per user')
+    optparser.add_option('--dedup',
+                         metavar='FILE',
+                         dest="dedup",
+                         default=None,
+                         help='index of messages kept in FILE across folders and runs; each message is uploaded once, with the labels of every folder it appears in')
+    optparser.add_option('--dedup-capacity',
+                         metavar='N',
+                         dest="dedup_capacity",
+                         type="int",
+                         default=10**7,
+                         help='expected number of messages in the --dedup index, to size its Bloom filter')
+    optparser.add_option('--rate',
+                         metavar='N',
+                         dest="rate",
+                         type="float",
+                         default=None,
+                         help='maximum number of messages uploaded per second')
+    optparser.add_option('--retries',
+                         metavar='N',
+                         dest="retries",
+                         type="int",
+                         default=migration.MAX_RETRIES,
+                         help='times to retry a message after a transient error, e.g. throttling')
+    optparser.add_option('--token-cache',
+                         metavar='FILE',
+                         dest="token_cache",
+                         default=None,
+                         help='file in which the authentication token is kept between runs and shared with --jobs workers')
+    optparser.add_option('--max-size',
+                         metavar='BYTES',
+                         dest="max_size",
+                         type="int",
+                         default=migration.MAX_MESSAGE_SIZE,
+                         help='messages larger than this are written to the failed mbox without being uploaded')
+    optparser.add_option('--compress',
+                         dest="compress",
+                         default=False,
+                         action="store_true",
+                         help='gzip compress uploads, unless the server refuses them')
+
+    # planning
+    optparser.add_option("--plan",
+                         dest="plan",
+                         default=False,
+                         action="store_true",
+                         help="scan the folders and report message counts, sizes, labels and an ETA, without uploading")
+    optparser.add_option("--throughput",
+                         metavar='N',
+                         dest="throughput",
+                         type="float",
+                         default=None,
+                         help="messages per second expected, for the --plan ETA (default is measured from --metrics-file)")
+    optparser.add_option("--bandwidth",
+                         metavar='MB',
+                         dest="bandwidth",
+                         type="float",
+                         default=None,
+                         help="megabytes per second expected, for the --plan ETA")
 
     # testing/debugging
     optparser.add_option('-t',
@@ -192,6 +1960,45 @@ be uploaded to your Inbox, starred, and labeled with 'priority'.
                           default=False, 
                           action="store_true",
                           help="Turn on debugging output" )
+    optparser.add_option('-r',
+                          "--resume",
+                          dest="resume",
+                          default=False, 
+                          action="store_true",
+                          help="Skip messages already uploaded by an earlier run, as recorded in each mbox file's .journal file" )
+    optparser.add_option("--order",
+                          metavar="ORDER",
+                          dest="order",
+                          default=None,
+                          help="upload messages across all folders in this order rather than folder by folder: "
+                               "a comma separated list of %s, e.g. inbox,newest" % ', '.join(SCHEDULE_ORDERS) )
+    optparser.add_option("--retry-failed",
+                          dest="retry_failed",
+                          default=False,
+                          action="store_true",
+                          help="Upload again the messages of each mbox file that are in its failed mbox" )
+    optparser.add_option('-p',
+                          "--progress",
+                          dest="progress",
+                          default=False, 
+                          action="store_true",
+                          help="Periodically print throughput, failures, retries and where request time goes" )
+    optparser.add_option("--metrics-file",
+                          metavar="PATH",
+                          dest="metrics_file",
+                          default=None,
+                          help="Periodically write metrics to PATH in Prometheus text format" )
+    optparser.add_option("--statsd",
+                          metavar="HOST:PORT",
+                          dest="statsd",
+                          default=None,
+                          help="Periodically send metrics to a StatsD daemon" )
+    optparser.add_option("--metrics-interval",
+                          metavar="SECONDS",
+                          dest="metrics_interval",
+                          type="float",
+                          default=10.0,
+                          help="Seconds between progress lines and metrics updates" )
     optparser.add_option('-d',
                           "--dry-run", 
                           dest="dryrun",
@@ -208,6 +2015,32 @@ be uploaded to your Inbox, starred, and labeled with 'priority'.
     options.email = email
     options.password = password
     
+    if options.concurrency < 1:
+        optparser.error("Concurrency must be positive: %d" % options.concurrency)
+    if options.user_concurrency < 1:
+        optparser.error("Concurrency must be positive: %d" % options.user_concurrency)
+    if options.statsd and ':' not in options.statsd:
+        optparser.error("Expected HOST:PORT: %s" % options.statsd)
+    if options.jobs < 1:
+        optparser.error("Jobs must be positive: %d" % options.jobs)
+    if options.dedup and options.manifest:
+        optparser.error("--dedup cannot be combined with --manifest")
+    if options.dedup and options.retry_failed:
+        optparser.error("--dedup cannot be combined with --retry-failed")
+    if options.order:
+        for order in options.order.split(','):
+            if order not in SCHEDULE_ORDERS:
+                optparser.error("Unknown order: %s" % order)
+        for option, value in (('--jobs', options.jobs > 1), 
+                              ('--manifest', options.manifest), 
+                              ('--retry-failed', options.retry_failed)):
+            if value:
+                optparser.error("--order cannot be combined with %s" % option)
+    if options.jobs > 1 and options.manifest:
+        optparser.error("--jobs cannot be combined with --manifest")
+    if options.manifest and not os.path.isfile(options.manifest):
+        optparser.error("Nonexistent manifest: %s" % options.manifest)
+    
     if not os.path.isabs(options.input):
         options.input = os.path.abspath(options.input)
         if not os.path.exists(options.input):
@@ -34,10 +34,16 @@ History:
 ##############################################################################
 ##############################################################################
 
-import datetime, time, sys
-import xml.dom.minidom
-from xml.etree import ElementTree
-import httplib, urllib, urllib2
+import datetime, time, sys, os, threading, Queue, socket, urlparse, random, mmap
+import asyncore, collections, errno, heapq, itertools, ssl
+import email.utils
+from StringIO import StringIO
+import httplib, urllib, urllib2, zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 ##############################################################################
 ##############################################################################
@@ -45,6 +51,28 @@ import httplib, urllib, urllib2
 # Per-request timeout
 HTTP_TIMEOUT = 10.0
 
+# Default number of requests in flight per upload_messages call
+UPLOAD_CONCURRENCY = 1
+
+# Maximum number of idle keep-alive connections kept per host
+POOL_SIZE = 8
+
+# Retries of a request that failed for a transient reason
+MAX_RETRIES = 5
+
+# Exponential backoff between retries, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+# Email Migration API limit on the size of one message (31.5 MB)
+MAX_MESSAGE_SIZE = 31 * 2**20 + 2**19
+
+# Messages at least this large are uploaded by workers of their own
+LARGE_MESSAGE_SIZE = 2**20
+
+# Request bodies smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 2**10
+
 # base64 encoding is deprecated
 ENCODING = 'utf-8'
 
@@ -61,13 +89,433 @@ def content_header(type):
 def length_header(body):
     return ('Content-Length', str(len(body)))
 
+##############################################################################
+# Instrumentation
+##############################################################################
+
+# Phases of an upload, in order, as timed by Metrics
+PHASES = ('schema', 'multipart', 'connect', 'send', 'wait', 'read')
+
+class Metrics(object):
+    r"""Thread-safe counters, gauges and timers for the upload hot path.
+    
+    Timings are accumulated per name as (count, total seconds); upload 
+    phases are recorded as 'phase.<name>' for each name in PHASES. Sinks 
+    read consistent copies with snapshot().
+    
+    """
+    
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+    
+    def increment(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+    
+    def gauge(self, name, value):
+        self.gauges[name] = value
+    
+    def timing(self, name, seconds):
+        self.lock.acquire()
+        try:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+        finally:
+            self.lock.release()
+    
+    def add(self, snapshot, since=None):
+        r"""Adds the counters and timers of a snapshot() taken elsewhere, e.g.
+        in another process, less those of its earlier snapshot `since`."""
+        counters, gauges, timers = snapshot
+        previous_counters, previous_gauges, previous_timers = since or ({}, {}, {})
+        self.lock.acquire()
+        try:
+            for name, value in counters.iteritems():
+                self.counters[name] = (self.counters.get(name, 0) 
+                                       + value - previous_counters.get(name, 0))
+            for name, (count, total) in timers.iteritems():
+                previous_count, previous_total = previous_timers.get(name, (0, 0.0))
+                timer = self.timers.setdefault(name, [0, 0.0])
+                timer[0] += count - previous_count
+                timer[1] += total - previous_total
+        finally:
+            self.lock.release()
+    
+    def snapshot(self):
+        r"""Returns a 3-tuple of copies of (counters, gauges, timers)."""
+        self.lock.acquire()
+        try:
+            return (dict(self.counters), 
+                    dict(self.gauges), 
+                    dict([(name, tuple(timer)) for name, timer in self.timers.iteritems()]))
+        finally:
+            self.lock.release()
+
+# Shared by default among all requests in this process
+METRICS = Metrics()
+
+def error_cause(error):
+    r"""Short name for the cause of a request failure, for metrics."""
+    if isinstance(error, MessageTooLarge):
+        return 'too_large'
+    if isinstance(error, urllib2.HTTPError):
+        return 'http_%d' % error.code
+    reason = getattr(error, 'reason', None)
+    if isinstance(reason, socket.timeout):
+        return 'timeout'
+    if isinstance(reason, socket.error):
+        return 'network'
+    return 'other'
+
+class PrometheusSink(object):
+    r"""Writes metrics to a file in the Prometheus text exposition format,
+    e.g. for the node exporter's textfile collector.
+    
+    The file is replaced atomically on each flush.
+    """
+    
+    def __init__(self, path, prefix='migration'):
+        self.path = path
+        self.prefix = prefix
+    
+    def name(self, name):
+        return '%s_%s' % (self.prefix, name.replace('.', '_').replace('-', '_'))
+    
+    def flush(self, metrics):
+        counters, gauges, timers = metrics.snapshot()
+        lines = []
+        for name, value in sorted(counters.iteritems()):
+            name = self.name(name) + '_total'
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, value))
+        for name, value in sorted(gauges.iteritems()):
+            name = self.name(name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, value))
+        for name, (count, total) in sorted(timers.iteritems()):
+            name = self.name(name) + '_seconds'
+            lines.append('# TYPE %s summary' % name)
+            lines.append('%s_count %d' % (name, count))
+            lines.append('%s_sum %f' % (name, total))
+        name = self.name('elapsed') + '_seconds'
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %f' % (name, time.time() - metrics.started))
+        temporary = '%s.%d' % (self.path, os.getpid())
+        f = open(temporary, 'w')
+        try:
+            f.write('\n'.join(lines))
+            f.write('\n')
+        finally:
+            f.close()
+        os.rename(temporary, self.path)
+
+class StatsdSink(object):
+    r"""Sends metrics to a StatsD daemon over UDP.
+    
+    Counters are sent as the change since the previous flush, gauges as 
+    their current value, and timers as the mean duration in milliseconds 
+    of the requests completed since the previous flush.
+    """
+    
+    def __init__(self, host='localhost', port=8125, prefix='migration'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.counters = {}
+        self.timers = {}
+    
+    def flush(self, metrics):
+        counters, gauges, timers = metrics.snapshot()
+        lines = []
+        for name, value in counters.iteritems():
+            delta = value - self.counters.get(name, 0)
+            if delta:
+                lines.append('%s.%s:%d|c' % (self.prefix, name, delta))
+        for name, value in gauges.iteritems():
+            lines.append('%s.%s:%s|g' % (self.prefix, name, value))
+        for name, (count, total) in timers.iteritems():
+            last_count, last_total = self.timers.get(name, (0, 0.0))
+            if count > last_count:
+                mean = (total - last_total) / (count - last_count)
+                lines.append('%s.%s:%f|ms' % (self.prefix, name, mean * 1000))
+        self.counters = counters
+        self.timers = timers
+        # keep datagrams within a typical MTU
+        packet = []
+        for line in lines:
+            if packet and sum([len(l) + 1 for l in packet]) + len(line) > 1400:
+                self.send(packet)
+                packet = []
+            packet.append(line)
+        if packet:
+            self.send(packet)
+    
+    def send(self, lines):
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+class ProgressSink(object):
+    r"""Writes a one-line summary of progress since the previous flush.
+    
+    The phase breakdown shows where request time went: mostly 'wait' 
+    means the server is the bottleneck, mostly 'send' means bandwidth,
+    and mostly 'schema'/'multipart' means the client CPU. Retries and a
+    reduced concurrency limit indicate throttling.
+    """
+    
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.last = (time.time(), {}, {})
+    
+    def flush(self, metrics):
+        now = time.time()
+        counters, gauges, timers = metrics.snapshot()
+        then, last_counters, last_timers = self.last
+        self.last = (now, counters, timers)
+        elapsed = max(now - then, 1e-6)
+        delta = lambda name: counters.get(name, 0) - last_counters.get(name, 0)
+        retries = sum([value for name, value in counters.iteritems() if name.startswith('retries.')])
+        failures = sum([value for name, value in counters.iteritems() if name.startswith('failures.')])
+        phases = []
+        for phase in PHASES:
+            name = 'phase.' + phase
+            count, total = timers.get(name, (0, 0.0))
+            last_count, last_total = last_timers.get(name, (0, 0.0))
+            if count > last_count:
+                phases.append('%s %.1fms' % (phase, 1000 * (total - last_total) / (count - last_count)))
+        self.stream.write('[%s] %d uploaded (%.1f/s, %.2f MB/s), %d failed, %d retries, in flight %s/%s; %s\n'
+                          % (time.strftime('%H:%M:%S'),
+                             counters.get('messages.uploaded', 0),
+                             delta('messages.uploaded') / elapsed,
+                             delta('bytes.sent') / elapsed / 2**20,
+                             failures,
+                             retries,
+                             gauges.get('requests.in_flight', 0),
+                             gauges.get('requests.limit', '-'),
+                             ', '.join(phases) or 'idle'))
+        self.stream.flush()
+
+class Reporter(object):
+    r"""Flushes metrics to a set of sinks periodically from a daemon thread."""
+    
+    def __init__(self, sinks, interval=10.0, metrics=None):
+        self.sinks = sinks
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush(self.metrics)
+            except (IOError, OSError) as e:
+                sys.stderr.write('Error writing metrics: %s\n' % e)
+    
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                break
+            self.flush()
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def stop(self):
+        r"""Stops the thread and flushes once more."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+##############################################################################
+# Keep-alive connection pooling
+##############################################################################
+
+class ConnectionPool(object):
+    r"""Reuses persistent HTTP/HTTPS connections per host.
+    
+    Connections are checked out for the duration of one request and 
+    returned once the response has been read, so a pool is safe to share 
+    between threads. At most `maxsize` idle connections are kept per host;
+    extras are closed. A request on a reused connection that finds the 
+    socket closed by the server is retried once on a fresh connection.
+    
+    Errors are reported the way urllib2.urlopen reports them: 
+    urllib2.HTTPError for error status codes and urllib2.URLError for 
+    network and protocol failures.
+    
+    """
+    
+    CONNECTIONS = { 'http' : httplib.HTTPConnection,
+                    'https' : httplib.HTTPSConnection }
+    
+    # Raised when a kept-alive socket has been closed by the other end
+    STALE_ERRORS = (httplib.BadStatusLine, 
+                    httplib.CannotSendRequest,
+                    httplib.ResponseNotReady,
+                    socket.error)
+    
+    def __init__(self, maxsize=POOL_SIZE, timeout=HTTP_TIMEOUT, metrics=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.metrics = metrics or METRICS
+        self.idle = {}
+        self.lock = threading.Lock()
+    
+    def connect(self, scheme, netloc):
+        if scheme not in self.CONNECTIONS:
+            raise urllib2.URLError('unsupported scheme: %s' % scheme)
+        return self.CONNECTIONS[scheme](netloc, timeout=self.timeout)
+    
+    def get(self, key):
+        r"""Returns a 2-tuple of (connection, reused)."""
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+        finally:
+            self.lock.release()
+        return self.connect(*key), False
+    
+    def put(self, key, connection):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                connection = None
+        finally:
+            self.lock.release()
+        if connection is not None:
+            connection.close()
+    
+    def close(self):
+        r"""Closes all idle connections."""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+    
+    def urlopen(self, url, body=None, headers=(), method=None):
+        r"""Issues a request and reads the complete response.
+        
+        Args:
+            url: absolute http or https URL
+            body: optional request body, either a string or a re-iterable
+                  of strings and buffers with Content-Length in headers
+                  (default method is POST if given)
+            headers: sequence of 2-tuples
+            method: optional HTTP method
+        
+        Returns:
+            A file-like response in the style of urllib2.urlopen.
+        
+        Raises:
+            urllib2.URLError
+        
+        """
+        if method is None:
+            method = body is None and 'GET' or 'POST'
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path = '%s?%s' % (path, query)
+        key = (scheme, netloc)
+        headers = dict(headers)
+        metrics = self.metrics
+        while True:
+            connection, reused = self.get(key)
+            try:
+                if connection.sock is None:
+                    start = time.time()
+                    connection.connect()
+                    # headers and body chunks are written separately
+                    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    metrics.timing('phase.connect', time.time() - start)
+                    metrics.increment('connections.opened')
+                start = time.time()
+                if body is None or isinstance(body, basestring):
+                    connection.request(method, path, body, headers)
+                else:
+                    self.send(connection, method, path, body, headers)
+                sent = time.time()
+                response = connection.getresponse()
+                received = time.time()
+                data = response.read()
+                metrics.timing('phase.send', sent - start)
+                metrics.timing('phase.wait', received - sent)
+                metrics.timing('phase.read', time.time() - received)
+            except self.STALE_ERRORS as e:
+                connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                raise urllib2.URLError(e)
+            except httplib.HTTPException as e:
+                connection.close()
+                raise urllib2.URLError(e)
+            break
+        metrics.increment('bytes.sent', int(headers.get('Content-Length', body and len(body) or 0)))
+        metrics.increment('bytes.received', len(data))
+        if response.will_close:
+            connection.close()
+        else:
+            self.put(key, connection)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, 
+                                    response.msg, StringIO(data))
+        return urllib.addinfourl(StringIO(data), response.msg, url, response.status)
+    
+    def send(self, connection, method, path, chunks, headers):
+        r"""Writes a request whose body is an iterable of chunks.
+        
+        Each chunk is written to the socket directly, without first being
+        joined into one string. The caller supplies Content-Length.
+        """
+        connection.putrequest(method, path)
+        for header in headers.iteritems():
+            connection.putheader(*header)
+        connection.endheaders()
+        for chunk in chunks:
+            connection.send(chunk)
+    
+# Shared by default among all requests in this process
+CONNECTIONS = ConnectionPool()
+
 ##############################################################################
 ##############################################################################
 
 class Multipart(object):
-    r"""Multipart Content Type."""
+    r"""Multipart Content Type.
+    
+    Besides str(), the encoded content can be streamed: iterating yields 
+    chunks of at most CHUNK_SIZE bytes, slicing part bodies without copying
+    them, and len() is computed from the part sizes.
+    """
     
     CRLF = '\r\n'
+    CHUNK_SIZE = 2**16
 
     def __init__(self, subtype, headers=None):
         self.subtype = subtype
@@ -83,24 +531,50 @@ class Multipart(object):
     def append(self, headers, body):
         self.parts.append((headers, body))
 
-    def encode_part(self, headers, body):
+    def encode_part(self, headers):
         part_boundary = '--' + self.boundary
         lines = [part_boundary]
         lines.extend([': '.join(h) for h in headers])
         lines.append('')
-        lines.append(body)
         return lines
+    
+    def encode(self):
+        r"""Returns the encoded content as a list of chunks.
         
-    def __str__(self):
+        Part bodies are included as-is rather than copied into one string,
+        so a body may be any object supporting the buffer interface 
+        (e.g. a buffer slice of a memory-mapped file).
+        """
+        chunks = []
         lines = []
         if self.headers:
             lines.extend([': '.join(h) for h in self.headers])
             lines.append('')
-        for part in self.parts:
-            lines.extend(self.encode_part(*part))
+        for headers, body in self.parts:
+            lines.extend(self.encode_part(headers))
+            lines.append('')
+            chunks.append(self.CRLF.join(lines))
+            chunks.append(body)
+            lines = ['']
         lines.append('--%s--' % self.boundary)
         lines.append('')
-        return self.CRLF.join(lines)
+        chunks.append(self.CRLF.join(lines))
+        return chunks
+        
+    def __str__(self):
+        return ''.join([str(chunk) for chunk in self.encode()])
+    
+    def __len__(self):
+        return sum([len(chunk) for chunk in self.encode()])
+    
+    def __iter__(self):
+        size = self.CHUNK_SIZE
+        for chunk in self.encode():
+            if len(chunk) <= size:
+                yield chunk
+            else:
+                for offset in xrange(0, len(chunk), size):
+                    yield buffer(chunk, offset, size)
     
 ##############################################################################
 # Sample email for testing
@@ -147,32 +621,191 @@ def encode_authentication_body(email, password):
     body = urllib.urlencode(fields)
     return body
 
-def authenticate(body):
+def authenticate(body, pool=None, server=None):
     r""" Returns an authentication token if successful. 
     
     Tokens expire after 24 hours.
     """
-    url = '%s/%s' % (AUTH_SERVER, AUTH_URL)
-    request = urllib2.Request(url, body)
-    request.add_header(*agent_header())
-    request.add_header(*content_header(AUTH_CONTENT_TYPE))
+    if pool is None:
+        pool = CONNECTIONS
+    if server is None:
+        server = AUTH_SERVER
+    url = '%s/%s' % (server, AUTH_URL)
+    response = pool.urlopen(url, body, authentication_headers(body))
+    return read_token(response)
+
+def authentication_headers(body):
+    return [agent_header(), 
+            content_header(AUTH_CONTENT_TYPE),
+            length_header(body)]
+
+def read_token(response):
+    r"""Returns the token in a ClientLogin response.
     
-    response = urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
+    Raises:
+        httplib.HTTPException
     
+    """
     body = response.read()
     for line in body.splitlines():
         tokens = line.split('Auth=')
         if len(tokens) > 1:
             assert len(tokens) == 2, line
-            token = tokens[1]
-            break
-    else:
-        raise httplib.HTTPException('%s\n%s' % (response.info(), body))
-    return token
+            return tokens[1]
+    raise httplib.HTTPException('%s\n%s' % (response.info(), body))
 
 def auth_header(token):
     return ('Authorization', 'GoogleLogin auth=%s' % token)
 
+# ClientLogin tokens are good for 24 hours; refresh an hour early
+TOKEN_LIFETIME = 24 * 60 * 60
+TOKEN_MARGIN = 60 * 60
+
+class TokenManager(object):
+    r"""Authentication token shared by every uploader of an account.
+    
+    The token is refreshed once it is within `margin` seconds of expiry,
+    and on demand after the server rejects it. Concurrent threads share a
+    single refresh.
+    
+    If `path` is given, the token and its issue time are cached in that 
+    file, so that restarts and worker processes reuse one ClientLogin; 
+    where fcntl is available, a lock file beside it makes sure only one
+    process refreshes at a time while the others wait for its token.
+    
+    Example Usage:
+    
+        >>> tokens = migration.TokenManager(my_email, my_password, '~/.migration-token')
+        >>> token = tokens.get()
+    
+    """
+    
+    def __init__(self, 
+                 email, 
+                 password, 
+                 path=None, 
+                 pool=None, 
+                 server=None,
+                 lifetime=TOKEN_LIFETIME,
+                 margin=TOKEN_MARGIN):
+        self.email = email
+        self.password = password
+        self.path = path and os.path.expanduser(path)
+        self.pool = pool
+        self.server = server
+        self.lifetime = lifetime
+        self.margin = margin
+        self.token = None
+        self.issued = 0
+        self.lock = threading.Lock()
+    
+    def expiring(self, issued=None, now=None):
+        if issued is None:
+            issued = self.issued
+        if now is None:
+            now = time.time()
+        return now - issued >= self.lifetime - self.margin
+    
+    def set(self, token, issued=None):
+        r"""Adopts a token obtained elsewhere, e.g. by a parent process."""
+        self.lock.acquire()
+        try:
+            self.token = token
+            self.issued = time.time() if issued is None else issued
+        finally:
+            self.lock.release()
+    
+    def current(self):
+        r"""Returns the token, refreshed if it is about to expire.
+        
+        Returns None if no token has been obtained yet.
+        """
+        token = self.token
+        if token is not None and self.expiring():
+            token = self.refresh(token)
+        return token
+    
+    def get(self):
+        r"""Returns a valid token, from the cache if possible."""
+        token = self.token
+        if token is None or self.expiring():
+            token = self.refresh(token)
+        return token
+    
+    def refresh(self, stale=None):
+        r"""Returns a new token to replace `stale`.
+        
+        If another thread or process has already replaced `stale` with a 
+        token that is not expiring, that token is returned instead of 
+        authenticating again.
+        
+        Raises:
+            urllib2.URLError
+            httplib.HTTPException
+        
+        """
+        self.lock.acquire()
+        try:
+            if self.token is not None and self.token != stale and not self.expiring():
+                return self.token
+            lock = self.lock_file()
+            try:
+                cached = self.load()
+                if cached is not None:
+                    token, issued = cached
+                    if token != stale and not self.expiring(issued):
+                        self.token, self.issued = token, issued
+                        return token
+                issued = time.time()
+                body = encode_authentication_body(self.email, self.password)
+                token = authenticate(body, self.pool, self.server)
+                self.save(token, issued)
+                self.token, self.issued = token, issued
+                return token
+            finally:
+                if lock is not None:
+                    lock.close()
+        finally:
+            self.lock.release()
+    
+    def lock_file(self):
+        if not self.path or fcntl is None:
+            return None
+        lock = open(self.path + '.lock', 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+    
+    def load(self):
+        r"""Returns the cached (token, issue time) for this account, or None."""
+        if not self.path:
+            return None
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return None
+        try:
+            lines = f.read().splitlines()
+        finally:
+            f.close()
+        if len(lines) != 3 or lines[0] != self.email:
+            return None
+        try:
+            return lines[2], float(lines[1])
+        except ValueError:
+            return None
+    
+    def save(self, token, issued):
+        if not self.path:
+            return
+        temp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write('%s\n%f\n%s\n' % (self.email, issued, token))
+        finally:
+            f.close()
+        os.rename(temp, self.path)
+
 ##############################################################################
 # Email Migration API
 ##############################################################################
@@ -192,59 +825,414 @@ APP_NAMESPACE = 'apps'
 MAIL_PROPERTY = 'mailItemProperty'
 LABEL_PROPERTY = 'label'
 
-def encode_mail_schema(properties=None, labels=None):
-    entry = ElementTree.Element('entry')
-    entry.set('xmlns', 'http://www.w3.org/2005/Atom')
-    entry.set('xmlns:apps', XML_NAMESPACE)
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
+KIND_SCHEME = 'http://schemas.google.com/g/2005#kind'
+MAIL_KIND = 'http://schemas.google.com/apps/2006#mailItem'
+
+# Maximum number of distinct (properties, labels) schemas kept
+SCHEMA_CACHE_SIZE = 128
+
+def xml_attribute(value):
+    if isinstance(value, unicode):
+        value = value.encode(ENCODING)
+    for char, entity in (('&', '&amp;'), 
+                         ('<', '&lt;'), 
+                         ('"', '&quot;'), 
+                         ('>', '&gt;')):
+        value = value.replace(char, entity)
+    return '"%s"' % value
+
+def build_mail_schema(properties=None, labels=None):
+    r"""Returns the Atom entry for a message, as an encoded string.
     
-    category = ElementTree.SubElement(entry, 'category')
-    category.set('scheme', 'http://schemas.google.com/g/2005#kind')
-    category.set('term', 'http://schemas.google.com/apps/2006#mailItem')
+    The document is written out directly rather than built as a tree.
+    """
+    apps = xml_attribute(XML_NAMESPACE)
+    lines = ['<?xml version="1.0" encoding="%s"?>' % ENCODING,
+             '<entry xmlns=%s xmlns:%s=%s>' % (xml_attribute(ATOM_NAMESPACE), APP_NAMESPACE, apps),
+             '<category scheme=%s term=%s/>' % (xml_attribute(KIND_SCHEME), xml_attribute(MAIL_KIND)),
+             '<atom:content type=%s xmlns:atom=%s/>' % (xml_attribute(MAIL_CONTENT_TYPE), xml_attribute(ATOM_NAMESPACE))]
     
-    content = ElementTree.SubElement(entry, 'atom:content')
-    content.set('xmlns:atom', 'http://www.w3.org/2005/Atom')
-    content.set('type', MAIL_CONTENT_TYPE)
-
     if properties:
         for flag in MAIL_FLAGS:
             if flag & properties:
-                property = ElementTree.SubElement(entry, '%s:%s' % (APP_NAMESPACE, MAIL_PROPERTY))
-                property.set('xmlns:apps', XML_NAMESPACE)
-                property.set('value', MAIL_PROPERTIES[flag])
+                lines.append('<%s:%s value=%s xmlns:%s=%s/>' % (APP_NAMESPACE, MAIL_PROPERTY,
+                                                               xml_attribute(MAIL_PROPERTIES[flag]),
+                                                               APP_NAMESPACE, apps))
     
     if labels:
         for l in labels:
-            label = ElementTree.SubElement(entry, '%s:%s' % (APP_NAMESPACE, LABEL_PROPERTY))
-            label.set('xmlns:apps', XML_NAMESPACE)
-            label.set('labelName', l)
-            
-    text = ElementTree.tostring(entry, encoding=ENCODING)
-    xmldoc = xml.dom.minidom.parseString(text)
-    return xmldoc.toxml(encoding=ENCODING)
+            lines.append('<%s:%s labelName=%s xmlns:%s=%s/>' % (APP_NAMESPACE, LABEL_PROPERTY,
+                                                               xml_attribute(l),
+                                                               APP_NAMESPACE, apps))
+    
+    lines.append('</entry>')
+    return ''.join(lines)
+
+class SchemaCache(object):
+    r"""Bounded least-recently-used cache of encoded schemas.
+    
+    Keys are the (properties, labels) combination, so uploads that repeat
+    a label set only pay for a dictionary lookup.
+    """
+    
+    def __init__(self, maxsize=SCHEMA_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = {}
+        self.clock = 0
+        self.lock = threading.Lock()
+    
+    def __call__(self, properties=None, labels=None):
+        key = (properties or 0, tuple(labels or ()))
+        self.lock.acquire()
+        try:
+            self.clock += 1
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[0] = self.clock
+                return entry[1]
+        finally:
+            self.lock.release()
+        schema = build_mail_schema(*key)
+        self.lock.acquire()
+        try:
+            if len(self.entries) >= self.maxsize:
+                # evict the least recently used
+                oldest = min(self.entries.iteritems(), key=lambda item: item[1][0])
+                del self.entries[oldest[0]]
+            self.entries[key] = [self.clock, schema]
+        finally:
+            self.lock.release()
+        return schema
+
+encode_mail_schema = SchemaCache()
 
 ##############################################################################
 
 SCHEMA_CONTENT_TYPE = 'application/atom+xml'
 MAIL_CONTENT_TYPE = 'message/rfc822'
 
-def post_mail(url, token, schema, message):
-    multipart = Multipart('related')
-    multipart.append([content_header(SCHEMA_CONTENT_TYPE)], schema)
-    multipart.append([content_header(MAIL_CONTENT_TYPE)], message)
-    body = str(multipart)
+class MailRequest(object):
+    r"""Prepared multipart/related request for uploads sharing one schema.
+    
+    The boundary, the schema part and the part headers are encoded once,
+    so that wrapping each message in a request body costs nearly nothing.
+    """
+    
+    def __init__(self, schema):
+        multipart = Multipart('related')
+        multipart.append([content_header(SCHEMA_CONTENT_TYPE)], schema)
+        multipart.append([content_header(MAIL_CONTENT_TYPE)], '')
+        chunks = multipart.encode()
+        self.head = ''.join(chunks[:-2])
+        self.tail = chunks[-1]
+        self.chunk_size = multipart.CHUNK_SIZE
+        self.content_type = content_header(multipart.content_type)
+    
+    def body(self, message, compress=False):
+        r"""Returns the request body of a message, gzip compressed if
+        `compress` is true and that makes it smaller."""
+        body = MailBody(self, message)
+        if compress and len(body) >= COMPRESS_MIN_SIZE:
+            compressed = CompressedBody(body)
+            if len(compressed) < len(body):
+                return compressed
+        return body
+    
+    def headers(self, token, body):
+        headers = [auth_header(token), self.content_type, length_header(body)]
+        if body.encoding:
+            headers.append(('Content-Encoding', body.encoding))
+        return headers
+
+class MailBody(object):
+    r"""Request body of one message, streamed like Multipart."""
+    
+    encoding = None
+    
+    def __init__(self, request, message):
+        self.request = request
+        self.message = message
+    
+    def __len__(self):
+        return len(self.request.head) + len(self.message) + len(self.request.tail)
+    
+    def __iter__(self):
+        size = self.request.chunk_size
+        message = self.message
+        yield self.request.head
+        if len(message) <= size:
+            yield message
+        else:
+            for offset in xrange(0, len(message), size):
+                yield buffer(message, offset, size)
+        yield self.request.tail
+    
+    def __str__(self):
+        return ''.join([self.request.head, str(self.message), self.request.tail])
+
+class CompressedBody(object):
+    r"""gzip compressed request body, sent with Content-Encoding: gzip."""
+    
+    encoding = 'gzip'
+    
+    def __init__(self, body):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunks = [compressor.compress(chunk) for chunk in body]
+        chunks.append(compressor.flush())
+        self.data = ''.join(chunks)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __iter__(self):
+        yield self.data
+    
+    def __str__(self):
+        return self.data
+
+class MessageTooLarge(urllib2.URLError):
+    r"""A message is over the size limit, so it was not sent."""
+    
+    def __init__(self, size, limit):
+        urllib2.URLError.__init__(self, 'Message of %d bytes exceeds the %d byte limit' 
+                                        % (size, limit))
+        self.size = size
+        self.limit = limit
+    
+    def __str__(self):
+        return self.reason
+
+def prefetch(message):
+    r"""Reads every page of a buffer, so that a memory-mapped message is 
+    brought in from disk before it is sent rather than while it is sent."""
+    if isinstance(message, buffer):
+        for offset in xrange(0, len(message), mmap.PAGESIZE):
+            message[offset]
+
+def post_request(url, token, request, message, pool=None, compress=False, body=None):
+    r"""Posts a message with a prepared MailRequest.
     
-    request = urllib2.Request(url, body)
-    request.add_header(*auth_header(token))
-    request.add_header(*content_header(multipart.content_type))
-    request.add_header(*length_header(body))
+    The request body may be given, already encoded by request.body().
+    """
+    if pool is None:
+        pool = CONNECTIONS
+    if body is None:
+        start = time.time()
+        body = request.body(message, compress)
+        pool.metrics.timing('phase.multipart', time.time() - start)
+    return pool.urlopen(url, body, request.headers(token, body))
+
+def log_failure(url, error, message):
+    r"""Reports a message that failed to upload, without its content or
+    the request headers, which carry the authentication token."""
+    sys.stderr.write('%s: %s (message of %d bytes)\n' % (url, error, len(message)))
+
+def post_mail(url, token, schema, message, pool=None):
+    return post_request(url, token, MailRequest(schema), message, pool)
+    
+##############################################################################
+# Rate limiting and retries
+##############################################################################
 
+# Responses indicating the server is overloaded or throttling us
+THROTTLE_STATUS = (429, 503)
+
+def is_retryable(error):
+    r"""True if a request failure is transient and worth retrying."""
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in THROTTLE_STATUS or error.code >= 500
+    return isinstance(getattr(error, 'reason', None), socket.error)
+
+def retry_after(error):
+    r"""Returns the server's Retry-After delay in seconds, or None."""
+    if not isinstance(error, urllib2.HTTPError) or error.info() is None:
+        return None
+    value = error.info().get('Retry-After')
+    if not value:
+        return None
     try:
-        response = urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
-    except urllib2.URLError as e:
-        sys.stderr.write('%s: %s:\n%s\%s\n' % (url, e, request.headers, request.data))
-        raise
-    else:
-        return response
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+def backoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    r"""Exponential backoff with full jitter."""
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+class Throttle(object):
+    r"""Client-side rate and concurrency control driven by server responses.
+    
+    Requests are admitted by a token bucket of `rate` requests per second
+    (unlimited if None), and at most `limit` requests may be in flight.
+    The limit adapts AIMD-style between 1 and `maximum`: it grows by one
+    after `limit` consecutive successes and halves whenever a request 
+    fails with a transient error. The maximum starts at `concurrency` and
+    is raised by widen() for callers that ask for more requests in 
+    flight. A Retry-After from the server pauses admission of all 
+    requests until it has passed.
+    
+    """
+    
+    def __init__(self, rate=None, concurrency=UPLOAD_CONCURRENCY, burst=None, metrics=None):
+        self.rate = rate
+        self.metrics = metrics or METRICS
+        self.burst = burst or max(1, concurrency)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.maximum = concurrency
+        self.limit = concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused = 0.0
+        self.condition = threading.Condition()
+    
+    def admit(self):
+        r"""Admits a request if one may be sent now, without blocking.
+        
+        Returns 0 if the request was admitted; otherwise the seconds to 
+        wait before trying again, or None to wait for a release(). Threads
+        sharing the throttle must hold its condition.
+        """
+        now = time.time()
+        wait = self.paused - now
+        if wait > 0:
+            return wait
+        if self.active >= self.limit:
+            return None
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.active += 1
+        self.metrics.gauge('requests.in_flight', self.active)
+        return 0
+    
+    def acquire(self):
+        r"""Blocks until a request may be sent."""
+        self.condition.acquire()
+        try:
+            wait = self.admit()
+            while wait != 0:
+                self.condition.wait(wait)
+                wait = self.admit()
+        finally:
+            self.condition.release()
+    
+    def widen(self, concurrency):
+        r"""Raises the maximum to allow `concurrency` requests in flight.
+        
+        Unless the limit has been cut back by errors, it is raised too, so
+        that a caller asking for more concurrency than the throttle was 
+        created with gets it straight away.
+        """
+        self.condition.acquire()
+        try:
+            if concurrency > self.maximum:
+                if self.limit >= self.maximum:
+                    self.limit = concurrency
+                self.maximum = concurrency
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+    
+    def release(self, error=None):
+        r"""Records the outcome of a request admitted by acquire()."""
+        self.condition.acquire()
+        try:
+            self.active -= 1
+            if error is None:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            elif is_retryable(error):
+                self.limit = max(1, self.limit / 2)
+                self.successes = 0
+                delay = retry_after(error)
+                if delay:
+                    self.paused = max(self.paused, time.time() + delay)
+            self.metrics.gauge('requests.in_flight', self.active)
+            self.metrics.gauge('requests.limit', self.limit)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+    
+class UploadQueue(object):
+    r"""Bounded queue of messages for the worker threads of Uploader.upload().
+    
+    Any worker may take any message, but no more than `large` messages of
+    LARGE_MESSAGE_SIZE or more are taken at a time; while that many are 
+    being posted, workers take the small messages queued behind them. At
+    most `depth` small and `large` large messages wait in the queue.
+    """
+    
+    def __init__(self, depth, large):
+        self.depth = depth
+        self.limit = large
+        self.small = collections.deque()
+        self.large = collections.deque()
+        self.active = 0
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def put(self, item, large=False):
+        r"""Blocks until there is room for another message of its size."""
+        if large:
+            queue, limit = self.large, self.limit
+        else:
+            queue, limit = self.small, self.depth
+        self.condition.acquire()
+        try:
+            while len(queue) >= limit:
+                self.condition.wait()
+            queue.append(item)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+    
+    def get(self):
+        r"""Blocks until a message may be taken, and returns a 2-tuple of
+        (item, large), or None once the queue is closed and empty."""
+        self.condition.acquire()
+        try:
+            while True:
+                if self.large and self.active < self.limit:
+                    self.active += 1
+                    self.condition.notifyAll()
+                    return self.large.popleft(), True
+                if self.small:
+                    self.condition.notifyAll()
+                    return self.small.popleft(), False
+                if self.closed and not self.large:
+                    return None
+                self.condition.wait()
+        finally:
+            self.condition.release()
+    
+    def done(self, large):
+        r"""Records that a message taken by get() has been dealt with."""
+        if large:
+            self.condition.acquire()
+            try:
+                self.active -= 1
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+    
+    def close(self):
+        r"""No more messages will be put; workers stop once it is empty."""
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
     
 ##############################################################################
 # Convenience front end
@@ -253,7 +1241,70 @@ def post_mail(url, token, schema, message):
 API_VERSION = '2.0'
 APPS_SERVER = 'https://apps-apis.google.com'
 
-class EmailMigrationService(object):
+class BaseMigrationService(object):
+    r"""Account, settings and shared state of a migration service.
+    
+    Holds what EmailMigrationService and AsyncEmailMigrationService have
+    in common: the TokenManager, the Throttle of requests in flight and
+    the feed URL of each user. How tokens are obtained and messages are
+    uploaded is left to them.
+    """
+    
+    FEED = '/a/feeds/migration/%(version)s/%(domain)s/%(username)s/mail'
+    
+    def __init__(self, 
+                 email, 
+                 password, 
+                 concurrency=UPLOAD_CONCURRENCY, 
+                 pool=None,
+                 rate=None,
+                 retries=MAX_RETRIES,
+                 server=None,
+                 auth_server=None,
+                 token_cache=None,
+                 max_size=MAX_MESSAGE_SIZE,
+                 compress=False,
+                 login_pool=None):
+        r"""Takes the arguments of EmailMigrationService, except that the 
+        pool is required, and the ConnectionPool the TokenManager logs in
+        with (default is shared by the process)."""
+        self.email = email
+        self.password = password
+        self.concurrency = concurrency
+        self.pool = pool
+        self.metrics = self.pool.metrics
+        self.throttle = Throttle(rate, concurrency, metrics=self.metrics)
+        self.retries = retries
+        self.server = server or APPS_SERVER
+        self.auth_server = auth_server or AUTH_SERVER
+        self.tokens = TokenManager(email, password, token_cache, 
+                                   login_pool, self.auth_server)
+        self.max_size = max_size
+        self.compress = compress
+    
+    def _set_token(self, token):
+        self.tokens.set(token)
+    
+    def feed_url(self, username=None, domain=None):
+        r"""Returns the URL of a user's mail feed.
+        
+        Args:
+            username: optional Google username (default is from the authenticating email)
+            domain: optional Google domain (default is from the authenticating email)
+        
+        """
+        if not username:
+            username = self.email.split('@')[0]
+        if not domain:
+            domain = self.email.split('@')[1]
+        feed = self.FEED % { 'version' : API_VERSION,
+                             'username' : username,
+                             'domain' : domain }
+        return '%s%s' % (self.server, feed)
+
+##############################################################################
+
+class EmailMigrationService(BaseMigrationService):
     r"""Interface to email migration functions.
     
     Example Usage:
@@ -273,39 +1324,109 @@ class EmailMigrationService(object):
     
     """
     
-    FEED = '/a/feeds/migration/%(version)s/%(domain)s/%(username)s/mail'
-    
-    def __init__(self, email, password):
+    def __init__(self, 
+                 email, 
+                 password, 
+                 concurrency=UPLOAD_CONCURRENCY, 
+                 pool=None,
+                 rate=None,
+                 retries=MAX_RETRIES,
+                 server=None,
+                 auth_server=None,
+                 token_cache=None,
+                 max_size=MAX_MESSAGE_SIZE,
+                 compress=False):
         r"""Initialize service with authentication parameters.
         
         Args:
             email: email address of the domain administrator or user
             password: password for the domain administrator or user
+            concurrency: default maximum number of requests in flight
+            pool: optional ConnectionPool (default is shared by the process);
+                  its Metrics also record this service's uploads
+            rate: optional maximum number of requests per second
+            retries: number of times a transiently failing request is retried
+            server: optional base URL of the Email Migration API (default is APPS_SERVER)
+            auth_server: optional base URL of the ClientLogin service (default is AUTH_SERVER)
+            token_cache: optional file in which the token is shared between
+                         processes and runs (see TokenManager)
+            max_size: messages larger than this many bytes fail without being sent
+            compress: if true, request bodies are gzip compressed, until the
+                      server answers 415 (Unsupported Media Type)
             
         """
-        self.email = email
-        self.password = password
-        self.token = None
+        pool = pool or CONNECTIONS
+        BaseMigrationService.__init__(self, email, password, concurrency, pool, rate,
+                                      retries, server, auth_server, token_cache,
+                                      max_size, compress, login_pool=pool)
+    
+    def _get_token(self):
+        return self.tokens.current()
+    
+    token = property(_get_token, BaseMigrationService._set_token, 
+                     doc="The authentication token, refreshed before it expires.")
     
     def authenticate(self):
-        r"""Request a fresh authentication token."""
-        request = encode_authentication_body(self.email, self.password)
-        self.token = authenticate(request)
+        r"""Obtain an authentication token, from the token cache if possible."""
+        self.tokens.get()
+    
+    def uploader(self, properties=None, labels=None, username=None, domain=None):
+        r"""Returns an Uploader session for one destination and label set.
+        
+        Raises:
+            RuntimeError
+        
+        """
+        return Uploader(self, properties, labels, username, domain)
+    
+    def upload_stream(self, 
+                      messages, 
+                      properties=None, 
+                      labels=None, 
+                      username=None, 
+                      domain=None,
+                      concurrency=None,
+                      callback=None,
+                      tagged=False):
+        r"""Uploads a stream of emails, yielding failures as they happen.
+        
+        Takes the same arguments as upload_messages; the feed URL, schema
+        and request template are prepared once for the whole stream. With
+        `tagged`, messages are 2-tuples of (tag, message), as described 
+        for Uploader.upload().
+        
+        Returns:
+            A generator of 2-tuples of type (message, Exception).
+        
+        Raises:
+            RuntimeError
+        
+        """
+        uploader = self.uploader(properties, labels, username, domain)
+        return uploader.upload(messages, concurrency, callback, tagged)
     
     def upload_messages(self, 
                         messages, 
                         properties=None, 
                         labels=None, 
                         username=None, 
-                        domain=None):
+                        domain=None,
+                        concurrency=None,
+                        callback=None):
         r"""Issues post requests for a sequence of emails.
         
+        Messages are consumed lazily from the sequence, so it may be a 
+        generator; at most `concurrency` messages are held in flight.
+        
         Args:
-            message: sequence of strings
+            message: sequence of strings or buffers
             properties: optional bitwise combination of MAIL_FLAGS
             labels: optional sequence of strings
             username: optional Google username (default is from the authenticating email)
             domain: optional Google domain (default is from the authenticating email)
+            concurrency: optional maximum number of requests in flight (default is self.concurrency)
+            callback: optional function called with each message as soon as it 
+                      has uploaded successfully (possibly from another thread)
         
         Returns:
             A sequence of 2-tuples of type (string, Exception).
@@ -316,25 +1437,1066 @@ class EmailMigrationService(object):
             RuntimeError
         
         """
-        if not self.token:
+        return list(self.upload_stream(messages, properties, labels, 
+                                       username, domain, concurrency, callback))
+
+##############################################################################
+
+class BaseUploader(object):
+    r"""Feed URL, mail schema and request template of an upload session.
+    
+    These are set up once, so the per-message work outside the network is
+    only wrapping the message. Uploader and AsyncUploader post with them.
+    """
+    
+    def __init__(self, service, properties=None, labels=None, username=None, domain=None):
+        if not service.token:
             raise RuntimeError('Authentication required first')
-        if not username:
-            username = self.email.split('@')[0]
-        if not domain:
-            domain = self.email.split('@')[1]
-        feed = self.FEED % { 'version' : API_VERSION,
-                             'username' : username,
-                             'domain' : domain }
-        url = '%s%s' % (APPS_SERVER, feed)
+        self.service = service
+        self.url = service.feed_url(username, domain)
+        start = time.time()
         schema = encode_mail_schema(properties, labels)
-        failed = []
-        for message in messages:
+        self.request = MailRequest(schema)
+        service.metrics.timing('phase.schema', time.time() - start)
+    
+    def encode(self, message):
+        r"""Returns the request body of a message, or None if it will not be sent."""
+        service = self.service
+        if service.max_size and len(message) > service.max_size:
+            return None
+        start = time.time()
+        body = self.request.body(message, service.compress)
+        service.metrics.timing('phase.multipart', time.time() - start)
+        return body
+
+##############################################################################
+
+class Uploader(BaseUploader):
+    r"""Upload session for one destination mailbox and label set.
+    
+    Messages are posted from the calling thread or from worker threads,
+    which block on the network.
+    
+    Example Usage:
+    
+        >>> uploader = service.uploader(migration.MAIL_INBOX, ['archive'])
+        >>> for msg, reason in uploader.upload(messages):
+        ...   print "Error:", reason
+    
+    """
+    
+    def post(self, message, body=None):
+        r"""Posts one message, subject to throttling.
+        
+        The request body may be given, as encoded by encode().
+        
+        Transient failures (throttling, server errors and network errors)
+        are retried up to service.retries times after a jittered exponential
+        backoff, or the server's Retry-After if that is longer. A message
+        rejected with 401 is retried once, straight away, with a new token.
+        
+        A message over service.max_size fails at once, without being sent.
+        If the server does not accept compressed requests, compression is
+        turned off for the service and the message is sent again.
+        
+        Raises:
+            urllib2.URLError
+        
+        """
+        service = self.service
+        throttle = service.throttle
+        metrics = service.metrics
+        if service.max_size and len(message) > service.max_size:
+            metrics.increment('failures.too_large')
+            error = MessageTooLarge(len(message), service.max_size)
+            log_failure(self.url, error, message)
+            raise error
+        attempt = 0
+        reauthenticated = False
+        while True:
+            token = service.token
+            compress = service.compress
+            if body is not None and body.encoding and not compress:
+                body = None
+            throttle.acquire()
+            error = None
             try:
-                response = post_mail(url, self.token, schema, message)
+                post_request(self.url, token, self.request, message, service.pool, compress, body)
             except urllib2.URLError as e:
-                failed.append((message, e))
-        return failed
+                error = e
+            except Exception as e:
+                throttle.release(e)
+                raise
+            throttle.release(error)
+            if error is None:
+                metrics.increment('messages.uploaded')
+                return
+            if (not reauthenticated and isinstance(error, urllib2.HTTPError) 
+                and error.code == httplib.UNAUTHORIZED):
+                reauthenticated = True
+                metrics.increment('retries.%s' % error_cause(error))
+                service.tokens.refresh(token)
+                continue
+            if (compress and isinstance(error, urllib2.HTTPError) 
+                and error.code == httplib.UNSUPPORTED_MEDIA_TYPE):
+                service.compress = False
+                metrics.increment('retries.%s' % error_cause(error))
+                continue
+            if attempt >= service.retries or not is_retryable(error):
+                metrics.increment('failures.%s' % error_cause(error))
+                log_failure(self.url, error, message)
+                raise error
+            metrics.increment('retries.%s' % error_cause(error))
+            attempt += 1
+            time.sleep(max(retry_after(error) or 0, backoff(attempt)))
+    
+    def pipeline(self, messages, depth):
+        r"""Yields 3-tuples of (tag, message, request body), read and encoded ahead.
+        
+        Messages are taken from `messages`, an iterable of 2-tuples of 
+        (tag, message), and read into memory by a reader
+        thread, then encoded by an encoder thread, with queues of at most
+        `depth` messages between the stages. Disk reads and encoding thus
+        overlap with waiting on the network, while no more than a few 
+        messages are held in memory ahead of the sender.
+        """
+        done = object()
+        read = Queue.Queue(depth)
+        encoded = Queue.Queue(depth)
+        stopped = threading.Event()
+        errors = []
+        
+        def reader():
+            try:
+                for item in messages:
+                    prefetch(item[1])
+                    read.put(item)
+                    if stopped.isSet():
+                        break
+            except Exception:
+                errors.append(sys.exc_info())
+            read.put(done)
+        
+        def encoder():
+            while True:
+                item = read.get()
+                if item is done:
+                    break
+                tag, message = item
+                try:
+                    encoded.put((tag, message, self.encode(message)))
+                except Exception:
+                    errors.append(sys.exc_info())
+                    break
+                if stopped.isSet():
+                    break
+            encoded.put((done, None, None))
+        
+        stages = [threading.Thread(target=reader), threading.Thread(target=encoder)]
+        for thread in stages:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            while True:
+                tag, message, body = encoded.get()
+                if tag is done:
+                    break
+                yield tag, message, body
+        finally:
+            # unblock the stages if the consumer stopped early
+            stopped.set()
+            while [thread for thread in stages if thread.isAlive()]:
+                for queue in read, encoded:
+                    try:
+                        queue.get(timeout=0.01)
+                    except Queue.Empty:
+                        pass
+            for thread in stages:
+                thread.join()
+        if errors:
+            type, value, traceback = errors[0]
+            raise type, value, traceback
+    
+    def upload(self, messages, concurrency=None, callback=None, tagged=False):
+        r"""Uploads messages, yielding (message, exception) failures as they happen.
         
+        Messages are read and encoded ahead of the network by pipeline().
+        With concurrency above one, messages are posted from a pool of 
+        worker threads fed by bounded queues, so the messages are never 
+        read far ahead of the network. At most a quarter of the workers
+        post messages of LARGE_MESSAGE_SIZE or more at a time (see 
+        UploadQueue), so that a few huge messages cannot hold up the many
+        small ones behind them; otherwise every worker takes either.
+        
+        Args:
+            messages: iterable of strings or buffers
+            concurrency: optional maximum number of requests in flight (default is the service's)
+            callback: optional function called with each message as soon as it 
+                      has uploaded successfully (possibly from another thread)
+            tagged: if true, `messages` is an iterable of 2-tuples of 
+                    (tag, message), and the callback and failures are 
+                    given these 2-tuples in place of messages, so that 
+                    callers need not tell messages apart by identity
+        
+        """
+        if not concurrency:
+            concurrency = self.service.concurrency
+        self.service.throttle.widen(concurrency)
+        if not tagged:
+            messages = ((message, message) for message in messages)
+        
+        def report(tag, message):
+            if tagged:
+                return tag, message
+            return message
+        
+        messages = self.pipeline(messages, concurrency)
+        if concurrency <= 1:
+            for tag, message, body in messages:
+                try:
+                    self.post(message, body)
+                except urllib2.URLError as e:
+                    yield report(tag, message), e
+                else:
+                    if callback is not None:
+                        callback(report(tag, message))
+            return
+        
+        work = UploadQueue(concurrency, max(1, concurrency / 4))
+        failed = Queue.Queue()
+        errors = []
+        
+        def worker():
+            while True:
+                taken = work.get()
+                if taken is None:
+                    break
+                (tag, message, body), large = taken
+                try:
+                    self.post(message, body)
+                    if callback is not None:
+                        callback(report(tag, message))
+                except urllib2.URLError as e:
+                    failed.put((report(tag, message), e))
+                except Exception:
+                    # keep draining the queue so the producer cannot block,
+                    # and re-raise in the calling thread afterwards
+                    errors.append(sys.exc_info())
+                work.done(large)
+        
+        workers = [threading.Thread(target=worker) for i in xrange(concurrency)]
+        for thread in workers:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            for item in messages:
+                if errors:
+                    break
+                work.put(item, len(item[1]) >= LARGE_MESSAGE_SIZE)
+                while not failed.empty():
+                    yield failed.get()
+        finally:
+            messages.close()
+            work.close()
+            for thread in workers:
+                thread.join()
+        while not failed.empty():
+            yield failed.get()
+        if errors:
+            type, value, traceback = errors[0]
+            raise type, value, traceback
+        
+##############################################################################
+# Asynchronous client
+##############################################################################
+
+DEFAULT_PORTS = { 'http' : httplib.HTTP_PORT,
+                  'https' : httplib.HTTPS_PORT }
+
+# Bytes read from a socket at a time
+READ_SIZE = 2**16
+
+# Seconds between checks for timed out requests
+LOOP_TICK = 1.0
+
+# Errors of a non-blocking socket that only mean "not now"
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+class EventLoop(object):
+    r"""An asyncore socket map together with timed calls.
+    
+    Any number of pools, services and uploads may share one loop, which
+    serves all of their connections from the thread calling run().
+    Sockets are watched with poll(), so thousands of them may be open.
+    
+    Example Usage:
+        
+        >>> loop = migration.EventLoop()
+        >>> loop.call_later(1.0, sys.stdout.write, 'tick\n')
+        >>> loop.run()
+    
+    """
+    
+    def __init__(self):
+        self.map = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        # requests in flight
+        self.pending = 0
+    
+    def call_later(self, delay, function, *args):
+        r"""Calls function(*args) from the loop after `delay` seconds."""
+        heapq.heappush(self.timers, (time.time() + delay, self.sequence.next(), function, args))
+    
+    def run(self):
+        r"""Runs until no requests are in flight and no calls are due.
+        
+        Idle kept-alive connections stay open, but do not keep the loop
+        running. Exceptions raised by callbacks propagate from here.
+        """
+        timers = self.timers
+        checked = time.time()
+        while self.pending or timers:
+            timeout = LOOP_TICK
+            if timers:
+                timeout = max(0.0, min(timeout, timers[0][0] - time.time()))
+            if self.map:
+                asyncore.poll2(timeout, self.map)
+            elif timeout:
+                time.sleep(timeout)
+            now = time.time()
+            while timers and timers[0][0] <= now:
+                when, sequence, function, args = heapq.heappop(timers)
+                function(*args)
+            if now - checked >= LOOP_TICK:
+                checked = now
+                for channel in self.map.values():
+                    channel.check(now)
+
+class AsyncConnection(asyncore.dispatcher):
+    r"""One persistent HTTP or HTTPS connection of an AsyncConnectionPool.
+    
+    A request body is written chunk by chunk as the socket accepts it,
+    and the response is parsed as it arrives, with Content-Length,
+    chunked or close-delimited bodies. A request fails with
+    socket.timeout once the connection has been idle for the pool's
+    timeout.
+    """
+    
+    def __init__(self, pool, scheme, netloc):
+        asyncore.dispatcher.__init__(self, map=pool.loop.map)
+        self.pool = pool
+        self.loop = pool.loop
+        self.metrics = pool.metrics
+        self.scheme = scheme
+        self.netloc = netloc
+        self.handshaking = False
+        self.want_write = False
+        self.handler = None
+        self.outgoing = collections.deque()
+        self.chunks = None
+        self.buffer = ''
+        self.state = None
+        self.body = []
+        self.received = None
+        self.active = time.time()
+    
+    def open(self):
+        host, port = urllib.splitport(self.netloc)
+        port = int(port or DEFAULT_PORTS[self.scheme])
+        family, type, proto, name, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        self.create_socket(family, type)
+        # headers and body chunks are written separately
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.opened = time.time()
+        self.connect(address)
+    
+    def request(self, head, body, handler):
+        r"""Sends a request; handler(connection, error) is called once the
+        response has been read, or the request has failed.
+        
+        Raises:
+            socket.error
+        
+        """
+        if not self.connected and not self.connecting:
+            self.open()
+        self.outgoing.append(head)
+        if isinstance(body, basestring):
+            self.outgoing.append(body)
+        elif body is not None:
+            self.chunks = iter(body)
+        self.handler = handler
+        self.state = 'head'
+        self.buffer = ''
+        self.body = []
+        self.started = self.active = time.time()
+        self.sent = self.received = None
+        self.loop.pending += 1
+    
+    def finish(self, error=None):
+        handler = self.handler
+        if handler is None:
+            return
+        self.handler = None
+        if error is None and (self.outgoing or self.chunks is not None):
+            # answered before the request was written in full
+            self.will_close = True
+        self.chunks = None
+        self.outgoing.clear()
+        self.loop.pending -= 1
+        if error is None:
+            now = time.time()
+            sent = self.sent or self.received
+            self.data = ''.join(self.body)
+            self.metrics.timing('phase.send', sent - self.started)
+            self.metrics.timing('phase.wait', self.received - sent)
+            self.metrics.timing('phase.read', now - self.received)
+        self.body = []
+        handler(self, error)
+    
+    def check(self, now):
+        if self.handler is not None and self.pool.timeout and now - self.active >= self.pool.timeout:
+            self.close()
+            self.finish(socket.timeout('timed out'))
+    
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.pool.discard(self)
+    
+    # asyncore events
+    
+    def readable(self):
+        return True
+    
+    def writable(self):
+        if not self.connected:
+            return self.connecting
+        if self.handshaking:
+            return self.want_write
+        return bool(self.outgoing) or self.chunks is not None
+    
+    def handle_connect(self):
+        self.metrics.timing('phase.connect', time.time() - self.opened)
+        self.metrics.increment('connections.opened')
+        if self.scheme == 'https':
+            host = urllib.splitport(self.netloc)[0]
+            self.del_channel()
+            if self.pool.context is not None:
+                sock = self.pool.context.wrap_socket(self.socket, server_hostname=host,
+                                                     do_handshake_on_connect=False)
+            else:
+                sock = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+            self.set_socket(sock, self.loop.map)
+            self.handshaking = True
+    
+    def handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want_write = False
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want_write = True
+                return
+            raise
+        self.handshaking = False
+        self.want_write = False
+    
+    def handle_write(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        outgoing = self.outgoing
+        while True:
+            if not outgoing:
+                if self.chunks is None:
+                    return
+                try:
+                    outgoing.append(self.chunks.next())
+                except StopIteration:
+                    self.chunks = None
+                    self.sent = time.time()
+                    return
+            chunk = outgoing[0]
+            try:
+                sent = self.socket.send(chunk)
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            self.active = time.time()
+            if sent < len(chunk):
+                outgoing[0] = buffer(chunk, sent)
+                return
+            outgoing.popleft()
+            if not outgoing and self.chunks is None:
+                self.sent = self.active
+    
+    def handle_read(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        while True:
+            try:
+                data = self.socket.recv(READ_SIZE)
+            except ssl.SSLError as e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if not data:
+                self.handle_close()
+                return
+            if self.handler is None:
+                # nothing is expected on an idle connection
+                self.close()
+                return
+            self.active = time.time()
+            if self.received is None:
+                self.received = self.active
+            self.buffer += data
+            self.parse()
+    
+    def handle_close(self):
+        self.close()
+        if self.handler is None:
+            return
+        if self.state == 'close':
+            self.body.append(self.buffer)
+            self.finish()
+        else:
+            self.finish(socket.error(errno.ECONNRESET, 'Connection closed by server'))
+    
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.finish(error)
+    
+    # response parsing
+    
+    def parse(self):
+        while self.handler is not None:
+            state = self.state
+            if state == 'head':
+                end = self.buffer.find('\r\n\r\n')
+                if end < 0:
+                    return
+                head = self.buffer[:end + 2]
+                self.buffer = self.buffer[end + 4:]
+                self.start(head)
+            elif state == 'body':
+                if len(self.buffer) < self.length:
+                    return
+                self.body.append(self.buffer[:self.length])
+                self.buffer = self.buffer[self.length:]
+                self.finish()
+            elif state == 'chunk':
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return
+                self.length = int(self.buffer[:end].split(';', 1)[0], 16)
+                self.buffer = self.buffer[end + 2:]
+                self.state = self.length and 'chunk-data' or 'trailer'
+            elif state == 'chunk-data':
+                if len(self.buffer) < self.length + 2:
+                    return
+                self.body.append(self.buffer[:self.length])
+                self.buffer = self.buffer[self.length + 2:]
+                self.state = 'chunk'
+            elif state == 'trailer':
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return
+                self.buffer = self.buffer[end + 2:]
+                if not end:
+                    self.finish()
+            else:
+                self.body.append(self.buffer)
+                self.buffer = ''
+                return
+    
+    def start(self, head):
+        line, headers = head.split('\r\n', 1)
+        fields = line.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith('HTTP/') or not fields[1].isdigit():
+            raise httplib.BadStatusLine(line)
+        self.status = int(fields[1])
+        self.reason = len(fields) > 2 and fields[2] or ''
+        if self.status == httplib.CONTINUE:
+            return
+        self.msg = httplib.HTTPMessage(StringIO(headers + '\r\n'), 0)
+        connection = self.msg.getheader('connection', '').lower()
+        if fields[0] == 'HTTP/1.0':
+            self.will_close = 'keep-alive' not in connection
+        else:
+            self.will_close = 'close' in connection
+        length = self.msg.getheader('content-length')
+        if 'chunked' in self.msg.getheader('transfer-encoding', '').lower():
+            self.state = 'chunk'
+        elif self.status in (httplib.NO_CONTENT, httplib.NOT_MODIFIED) or self.status < 200:
+            self.length = 0
+            self.state = 'body'
+        elif length is not None:
+            self.length = int(length)
+            self.state = 'body'
+        else:
+            self.will_close = True
+            self.state = 'close'
+
+class AsyncConnectionPool(object):
+    r"""Non-blocking counterpart of ConnectionPool, driven by an EventLoop.
+    
+    Requests are started by urlopen(), which returns at once; the
+    callback is called from the loop with the response or the error,
+    which are those ConnectionPool.urlopen() would return or raise. Any
+    number of requests may be in flight, each on its own connection,
+    and at most `maxsize` idle connections are kept per host.
+    
+    If `context` is given, it is the ssl.SSLContext of HTTPS
+    connections; by default certificates are verified where the ssl
+    module can.
+    """
+    
+    def __init__(self, loop=None, maxsize=POOL_SIZE, timeout=HTTP_TIMEOUT, metrics=None, context=None):
+        self.loop = loop or EventLoop()
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.metrics = metrics or METRICS
+        if context is None and hasattr(ssl, 'create_default_context'):
+            context = ssl.create_default_context()
+        self.context = context
+        self.idle = {}
+    
+    def get(self, key):
+        r"""Returns a 2-tuple of (connection, reused)."""
+        connections = self.idle.get(key)
+        if connections:
+            return connections.pop(), True
+        if key[0] not in DEFAULT_PORTS:
+            raise urllib2.URLError('unsupported scheme: %s' % key[0])
+        return AsyncConnection(self, *key), False
+    
+    def put(self, key, connection):
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.maxsize:
+            connections.append(connection)
+        else:
+            connection.close()
+    
+    def discard(self, connection):
+        connections = self.idle.get((connection.scheme, connection.netloc))
+        if connections and connection in connections:
+            connections.remove(connection)
+    
+    def close(self):
+        r"""Closes all idle connections."""
+        idle = self.idle
+        self.idle = {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+    
+    def urlopen(self, url, body, headers, callback, method=None):
+        r"""Starts a request.
+        
+        Args:
+            url: absolute http or https URL
+            body: request body, as for ConnectionPool.urlopen(), or None
+            headers: sequence of 2-tuples
+            callback: function called from the loop with a 2-tuple of
+                      (response, error), one of which is None
+            method: optional HTTP method
+        
+        """
+        if method is None:
+            method = body is None and 'GET' or 'POST'
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path = '%s?%s' % (path, query)
+        headers = dict(headers)
+        headers.setdefault('Host', netloc)
+        headers.setdefault('Accept-Encoding', 'identity')
+        if isinstance(body, basestring) or (body is None and method in ('POST', 'PUT')):
+            headers.setdefault('Content-Length', str(len(body or '')))
+        lines = ['%s %s HTTP/1.1\r\n' % (method, path)]
+        lines.extend(['%s: %s\r\n' % header for header in headers.iteritems()])
+        lines.append('\r\n')
+        self.send(url, (scheme, netloc), ''.join(lines), body,
+                  int(headers['Content-Length']), callback)
+    
+    def send(self, url, key, head, body, length, callback):
+        metrics = self.metrics
+        
+        def finished(connection, error):
+            if error is not None:
+                # a kept-alive socket closed by the other end
+                if reused and connection.received is None and not isinstance(error, socket.timeout):
+                    self.send(url, key, head, body, length, callback)
+                    return
+                if not isinstance(error, urllib2.URLError):
+                    error = urllib2.URLError(error)
+                self.loop.call_later(0, callback, None, error)
+                return
+            data = connection.data
+            metrics.increment('bytes.sent', length)
+            metrics.increment('bytes.received', len(data))
+            if connection.will_close:
+                connection.close()
+            else:
+                self.put(key, connection)
+            if connection.status >= 400:
+                error = urllib2.HTTPError(url, connection.status, connection.reason,
+                                          connection.msg, StringIO(data))
+                self.loop.call_later(0, callback, None, error)
+            else:
+                response = urllib.addinfourl(StringIO(data), connection.msg, url, connection.status)
+                self.loop.call_later(0, callback, response, None)
+        
+        try:
+            connection, reused = self.get(key)
+            try:
+                connection.request(head, body, finished)
+            except socket.error:
+                connection.close()
+                raise
+        except (socket.error, urllib2.URLError) as e:
+            if not isinstance(e, urllib2.URLError):
+                e = urllib2.URLError(e)
+            self.loop.call_later(0, callback, None, e)
+
+##############################################################################
+
+class AsyncEmailMigrationService(BaseMigrationService):
+    r"""Non-blocking interface to email migration functions.
+    
+    Takes the same arguments as EmailMigrationService, except that the
+    pool must be an AsyncConnectionPool (by default, a new one with its
+    own EventLoop). Nothing blocks on the network: methods start their
+    work and return, and callbacks are called from the loop as it
+    finishes. Services of many users may share one pool and loop.
+    
+    The upload methods take callbacks in place of returning failures, so
+    this is not an EmailMigrationService, only built on the same base.
+    
+    Example Usage:
+        
+        >>> loop = migration.EventLoop()
+        >>> pool = migration.AsyncConnectionPool(loop)
+        >>> service = migration.AsyncEmailMigrationService(my_email, my_password,
+        ...                                                100, pool=pool)
+        >>> def uploaded(failed):
+        ...   for msg, reason in failed:
+        ...     print "Error:", reason
+        >>> def authenticated(token, error):
+        ...   service.upload_messages(messages, uploaded, migration.MAIL_INBOX, ['testing'])
+        >>> service.authenticate(authenticated)
+        >>> loop.run()
+    
+    """
+    
+    def __init__(self, email, password, concurrency=UPLOAD_CONCURRENCY, pool=None, **options):
+        # ClientLogin is done on the loop by refresh(); the TokenManager
+        # keeps the blocking pool of the process for its own logins
+        BaseMigrationService.__init__(self, email, password, concurrency,
+                                      pool or AsyncConnectionPool(), **options)
+        self.loop = self.pool.loop
+        self.waiting = collections.deque()
+        self.admitting = False
+        self.refreshing = []
+    
+    def _get_token(self):
+        return self.tokens.token
+    
+    token = property(_get_token, BaseMigrationService._set_token,
+                     doc="The authentication token; see refresh().")
+    
+    def authenticate(self, callback=None):
+        r"""Obtains a token, from the token cache if possible, and calls
+        callback(token, error) with it or with the urllib2.URLError."""
+        self.refresh(callback or (lambda token, error: None))
+    
+    def refresh(self, callback, stale=None):
+        r"""Obtains a new token to replace `stale`, then calls
+        callback(token, error).
+        
+        As with TokenManager.refresh(), a token that has already replaced
+        `stale` is used as it is, and concurrent refreshes share a single
+        ClientLogin. The token cache file is read and written, but not
+        locked, since that could block the loop.
+        """
+        tokens = self.tokens
+        if tokens.token is not None and tokens.token != stale and not tokens.expiring():
+            callback(tokens.token, None)
+            return
+        cached = tokens.load()
+        if cached is not None:
+            token, issued = cached
+            if token != stale and not tokens.expiring(issued):
+                tokens.set(token, issued)
+                callback(token, None)
+                return
+        self.refreshing.append(callback)
+        if len(self.refreshing) > 1:
+            return
+        issued = time.time()
+        body = encode_authentication_body(self.email, self.password)
+        url = '%s/%s' % (self.auth_server, AUTH_URL)
+        
+        def authenticated(response, error):
+            token = None
+            if error is None:
+                try:
+                    token = read_token(response)
+                except httplib.HTTPException as e:
+                    error = urllib2.URLError(e)
+                else:
+                    tokens.save(token, issued)
+                    tokens.set(token, issued)
+            callbacks = self.refreshing
+            self.refreshing = []
+            for callback in callbacks:
+                callback(token, error)
+        
+        self.pool.urlopen(url, body, authentication_headers(body), authenticated)
+    
+    def acquire(self, function, *args):
+        r"""Calls function(*args) once the throttle admits a request."""
+        self.waiting.append((function, args))
+        self.admit()
+    
+    def release(self, error=None):
+        r"""Records the outcome of a request started by acquire()."""
+        self.throttle.release(error)
+        self.admit()
+    
+    def admit(self):
+        if self.admitting:
+            return
+        while self.waiting:
+            wait = self.throttle.admit()
+            if wait is None:
+                # until release()
+                return
+            if wait:
+                self.admitting = True
+                self.loop.call_later(wait, self.readmit)
+                return
+            function, args = self.waiting.popleft()
+            function(*args)
+    
+    def readmit(self):
+        self.admitting = False
+        self.admit()
+    
+    def uploader(self, properties=None, labels=None, username=None, domain=None):
+        r"""Returns an AsyncUploader session for one destination and label set.
+        
+        Raises:
+            RuntimeError
+        
+        """
+        return AsyncUploader(self, properties, labels, username, domain)
+    
+    def upload_stream(self,
+                      messages,
+                      failure,
+                      properties=None,
+                      labels=None,
+                      username=None,
+                      domain=None,
+                      concurrency=None,
+                      callback=None,
+                      done=None):
+        r"""Starts uploading a stream of emails, reporting failures as they happen.
+        
+        Takes the same arguments as upload_messages, except that
+        failure(message, error) is called for each failed message and
+        done(), if given, once every message has been dealt with.
+        
+        Raises:
+            RuntimeError
+        
+        """
+        uploader = self.uploader(properties, labels, username, domain)
+        uploader.upload(messages, concurrency, callback, failure, done)
+    
+    def upload_messages(self,
+                        messages,
+                        done,
+                        properties=None,
+                        labels=None,
+                        username=None,
+                        domain=None,
+                        concurrency=None,
+                        callback=None):
+        r"""Starts post requests for a sequence of emails.
+        
+        Messages are consumed lazily from the sequence, so it may be a
+        generator; at most `concurrency` messages are held in flight.
+        
+        Args:
+            message: sequence of strings or buffers
+            done: function called with a sequence of 2-tuples of type
+                  (string, Exception) once every message has been dealt
+                  with; each is a message that failed to upload and the
+                  exception that was generated from that request
+            properties: optional bitwise combination of MAIL_FLAGS
+            labels: optional sequence of strings
+            username: optional Google username (default is from the authenticating email)
+            domain: optional Google domain (default is from the authenticating email)
+            concurrency: optional maximum number of requests in flight (default is self.concurrency)
+            callback: optional function called with each message as soon as it
+                      has uploaded successfully
+        
+        Raises:
+            RuntimeError
+        
+        """
+        failed = []
+        self.upload_stream(messages, lambda message, error: failed.append((message, error)),
+                           properties, labels, username, domain, concurrency, callback,
+                           lambda: done(failed))
+
+##############################################################################
+
+class AsyncUploader(BaseUploader):
+    r"""Upload session of an AsyncEmailMigrationService.
+    
+    Shares the feed URL, schema and request template of Uploader, and
+    the same handling of failures, but posts without blocking: retries
+    are timed calls on the loop rather than sleeps.
+    
+    Messages are read and encoded on the loop, so a folder on a slow
+    disk, or compression of huge messages, holds up every upload
+    sharing the loop while it happens.
+    """
+    
+    def post(self, message, callback):
+        r"""Starts posting one message, subject to throttling, then calls
+        callback(message, error) with the urllib2.URLError, if any."""
+        service = self.service
+        if service.max_size and len(message) > service.max_size:
+            service.metrics.increment('failures.too_large')
+            error = MessageTooLarge(len(message), service.max_size)
+            log_failure(self.url, error, message)
+            service.loop.call_later(0, callback, message, error)
+            return
+        self.send(message, callback)
+    
+    def send(self, message, callback, attempt=0, reauthenticated=False):
+        service = self.service
+        if service.tokens.expiring():
+            def refreshed(token, error):
+                if error is not None:
+                    callback(message, error)
+                else:
+                    self.send(message, callback, attempt, reauthenticated)
+            service.refresh(refreshed, service.token)
+            return
+        service.acquire(self.attempt, message, callback, attempt, reauthenticated)
+    
+    def attempt(self, message, callback, attempt, reauthenticated):
+        service = self.service
+        metrics = service.metrics
+        token = service.token
+        compress = service.compress
+        body = self.encode(message)
+        
+        def posted(response, error):
+            service.release(error)
+            if error is None:
+                metrics.increment('messages.uploaded')
+                callback(message, None)
+                return
+            if (not reauthenticated and isinstance(error, urllib2.HTTPError)
+                and error.code == httplib.UNAUTHORIZED):
+                metrics.increment('retries.%s' % error_cause(error))
+                def refreshed(token, error):
+                    if error is not None:
+                        callback(message, error)
+                    else:
+                        self.send(message, callback, attempt, True)
+                service.refresh(refreshed, token)
+                return
+            if (compress and isinstance(error, urllib2.HTTPError)
+                and error.code == httplib.UNSUPPORTED_MEDIA_TYPE):
+                service.compress = False
+                metrics.increment('retries.%s' % error_cause(error))
+                self.send(message, callback, attempt, reauthenticated)
+                return
+            if attempt >= service.retries or not is_retryable(error):
+                metrics.increment('failures.%s' % error_cause(error))
+                log_failure(self.url, error, message)
+                callback(message, error)
+                return
+            metrics.increment('retries.%s' % error_cause(error))
+            service.loop.call_later(max(retry_after(error) or 0, backoff(attempt + 1)),
+                                    self.send, message, callback, attempt + 1, reauthenticated)
+        
+        service.pool.urlopen(self.url, body, self.request.headers(token, body), posted)
+    
+    def upload(self, messages, concurrency=None, callback=None, failure=None, done=None):
+        r"""Starts uploading messages, with at most `concurrency` in flight.
+        
+        Args:
+            messages: iterable of strings or buffers
+            concurrency: optional maximum number of requests in flight (default is the service's)
+            callback: optional function called with each message as soon as it
+                      has uploaded successfully
+            failure: optional function called with (message, exception)
+                     for each message that failed to upload
+            done: optional function called once every message has been dealt with
+        
+        """
+        concurrency = concurrency or self.service.concurrency
+        self.service.throttle.widen(concurrency)
+        AsyncUpload(self, messages, concurrency, callback, failure, done).fill()
+
+class AsyncUpload(object):
+    r"""Progress of one AsyncUploader.upload()."""
+    
+    def __init__(self, uploader, messages, concurrency, callback, failure, done):
+        self.uploader = uploader
+        self.messages = iter(messages)
+        self.concurrency = concurrency
+        self.callback = callback
+        self.failure = failure
+        self.done = done
+        self.in_flight = 0
+        self.exhausted = False
+    
+    def fill(self):
+        while not self.exhausted and self.in_flight < self.concurrency:
+            try:
+                message = self.messages.next()
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.in_flight += 1
+            self.uploader.post(message, self.posted)
+        if self.exhausted and not self.in_flight and self.done is not None:
+            done = self.done
+            self.done = None
+            done()
+    
+    def posted(self, message, error):
+        self.in_flight -= 1
+        if error is None:
+            if self.callback is not None:
+                self.callback(message)
+        elif self.failure is not None:
+            self.failure(message, error)
+        self.fill()
+
 ##############################################################################
 ##############################################################################
 
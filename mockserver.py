@@ -0,0 +1,277 @@
+#!/usr/bin/env python2.6
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+r"""Local stand-in for the Google Apps Email Migration API.
+
+Implements the ClientLogin endpoint and the migration mail feed closely
+enough for migration.py to run against it, with configurable latency,
+error rate and throttling, so that uploads can be measured offline.
+
+Example Usage:
+
+    > python mockserver.py --port 8080 --latency 0.05 --throttle 100
+
+    >>> import migration
+    >>> service = migration.EmailMigrationService('user@example.com', 'secret',
+    ...                                           server='http://localhost:8080',
+    ...                                           auth_server='http://localhost:8080')
+
+"""
+
+##############################################################################
+##############################################################################
+
+import sys, time, random, threading, socket, re, optparse, cgi, zlib
+import BaseHTTPServer, SocketServer
+
+import migration
+
+##############################################################################
+##############################################################################
+
+MOCK_TOKEN = 'mock-auth-token'
+
+FEED_PATTERN = re.compile(r'^/a/feeds/migration/(?P<version>[^/]+)/(?P<domain>[^/]+)/(?P<username>[^/]+)/mail$')
+
+ENTRY = ('<?xml version="1.0" encoding="UTF-8"?>'
+         '<entry xmlns="http://www.w3.org/2005/Atom">'
+         '<id>%(id)d</id></entry>')
+
+##############################################################################
+##############################################################################
+
+class Behavior(object):
+    r"""How the mock server misbehaves.
+
+    Args:
+        latency: mean seconds added before each response
+        jitter: maximum seconds of random variation in latency
+        error_rate: fraction of uploads answered with 500
+        throttle: optional uploads per second beyond which 503 is returned
+        retry_after: seconds suggested in the Retry-After of a 503
+        gzip: whether gzip compressed uploads are accepted
+
+    """
+
+    def __init__(self,
+                 latency=0.0,
+                 jitter=0.0,
+                 error_rate=0.0,
+                 throttle=None,
+                 retry_after=1,
+                 gzip=True):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.gzip = gzip
+        self.window = int(time.time())
+        self.admitted = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        if not self.throttle:
+            return False
+        self.lock.acquire()
+        try:
+            now = int(time.time())
+            if now != self.window:
+                self.window = now
+                self.admitted = 0
+            self.admitted += 1
+            return self.admitted > self.throttle
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        return self.error_rate and random.random() < self.error_rate
+
+class Statistics(object):
+    r"""Counters kept by the server."""
+
+    def __init__(self):
+        self.logins = 0
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        self.lock.acquire()
+        try:
+            for name, count in counts.iteritems():
+                setattr(self, name, getattr(self, name) + count)
+        finally:
+            self.lock.release()
+
+    def __str__(self):
+        return ('logins=%d messages=%d bytes=%d errors=%d throttled=%d'
+                % (self.logins, self.messages, self.bytes, self.errors, self.throttled))
+
+##############################################################################
+##############################################################################
+
+class MigrationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    r"""Serves ClientLogin and the migration mail feed over keep-alive HTTP."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self, code, body='', headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/' + migration.AUTH_URL:
+            self.login(body)
+            return
+        match = FEED_PATTERN.match(self.path)
+        if match is None:
+            self.respond(404, 'Not Found')
+            return
+        self.upload(body)
+
+    def login(self, body):
+        fields = cgi.parse_qs(body)
+        self.server.behavior.delay()
+        if not fields.get('Email') or not fields.get('Passwd'):
+            self.respond(403, 'Error=BadAuthentication\n')
+            return
+        self.server.statistics.add(logins=1)
+        self.respond(200, 'SID=mock\nLSID=mock\nAuth=%s\n' % MOCK_TOKEN)
+
+    def upload(self, body):
+        behavior = self.server.behavior
+        statistics = self.server.statistics
+        if self.headers.get('Authorization') != migration.auth_header(MOCK_TOKEN)[1]:
+            self.respond(401, 'Token invalid')
+            return
+        if not self.headers.get('Content-Type', '').startswith('multipart/related'):
+            self.respond(400, 'Expected multipart/related')
+            return
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not behavior.gzip:
+                self.respond(415, 'Unsupported Content-Encoding')
+                return
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if behavior.throttled():
+            statistics.add(throttled=1)
+            self.respond(503, 'Quota exceeded',
+                         [('Retry-After', str(behavior.retry_after))])
+            return
+        behavior.delay()
+        if behavior.failed():
+            statistics.add(errors=1)
+            self.respond(500, 'Internal Error')
+            return
+        statistics.add(messages=1, bytes=len(body))
+        self.respond(201, ENTRY % { 'id' : statistics.messages },
+                     [migration.content_header(migration.SCHEMA_CONTENT_TYPE)])
+
+class MigrationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    r"""Threaded mock server; use `url` as both API and ClientLogin server.
+
+    If certfile is given, connections are wrapped in SSL and the server
+    speaks HTTPS.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), behavior=None, certfile=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MigrationHandler)
+        self.behavior = behavior or Behavior()
+        self.statistics = Statistics()
+        self.verbose = verbose
+        self.scheme = 'http'
+        if certfile:
+            import ssl
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile, server_side=True)
+            self.scheme = 'https'
+
+    url = property(lambda self: '%s://%s:%d' % ((self.scheme,) + self.server_address[:2]))
+
+    def start(self):
+        r"""Serves from a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+##############################################################################
+##############################################################################
+
+def main(argv):
+    optparser = optparse.OptionParser(description='Serves a mock Google Apps Email Migration API.')
+    optparser.add_option('-p', '--port', dest='port', type='int', default=8080,
+                         help='port to listen on')
+    optparser.add_option('--host', dest='host', default='127.0.0.1',
+                         help='address to listen on')
+    optparser.add_option('--latency', dest='latency', type='float', default=0.0,
+                         help='mean seconds of latency added to each response')
+    optparser.add_option('--jitter', dest='jitter', type='float', default=0.0,
+                         help='maximum seconds of random variation in latency')
+    optparser.add_option('--error-rate', dest='error_rate', type='float', default=0.0,
+                         help='fraction of uploads that fail with 500')
+    optparser.add_option('--throttle', dest='throttle', type='int', default=None,
+                         help='uploads per second beyond which 503 is returned')
+    optparser.add_option('--retry-after', dest='retry_after', type='int', default=1,
+                         help='seconds of Retry-After sent with 503')
+    optparser.add_option('--no-gzip', dest='gzip', default=True, action='store_false',
+                         help='refuse gzip compressed uploads with 415')
+    optparser.add_option('--certfile', dest='certfile', default=None,
+                         help='PEM certificate and key, to serve HTTPS')
+    optparser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                         help='log every request')
+    options, args = optparser.parse_args(argv[1:])
+
+    behavior = Behavior(options.latency, options.jitter, options.error_rate,
+                        options.throttle, options.retry_after, options.gzip)
+    server = MigrationServer((options.host, options.port), behavior,
+                             options.certfile, options.verbose)
+    sys.stdout.write('Serving on %s\n' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stdout.write('%s\n' % server.statistics)
+
+##############################################################################
+##############################################################################
+
+if __name__ == '__main__':
+    main(sys.argv)
+
+##############################################################################
+##############################################################################